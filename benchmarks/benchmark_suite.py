@@ -0,0 +1,221 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Optional
+
+import torch
+from torch import Tensor
+
+from dataset_qm9_preprocessed.dataset import QM9Dataset
+from dataset_qm9_preprocessed.utils import ELEMENTS, collate_data_dicts, data_dict_from_xyz_str
+
+# Reuse the raw QM9 layout the tests are written against
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tests"))
+from fixtures import XYZ_STR, write_archive  # noqa: E402
+
+
+def synthetic_xyz_str(idx: int, rng: random.Random) -> str:
+    # Resample the atoms of the fixture molecule, keeping its header, frequencies, SMILES and InChI lines
+    lines = XYZ_STR.splitlines()
+    num_template_nodes = int(lines[0])
+    header, atom_lines, frequencies, smiles, inchi = lines[1], lines[2:2 + num_template_nodes], *lines[2 + num_template_nodes:5 + num_template_nodes]
+    num_nodes = rng.randint(3, 29)
+    atoms = []
+    for _ in range(num_nodes):
+        _, x, y, z, charge = rng.choice(atom_lines).split("\t")
+        x, y, z = (float(coordinate) + rng.uniform(-1.0, 1.0) for coordinate in (x, y, z))
+        # Mix in the Mathematica scientific notation found in a few raw files
+        z = f"{z * 10:.4f}*^-1" if rng.random() < 0.05 else f"{z:.10f}"
+        atoms.append(f"{rng.choice(ELEMENTS)}\t{x:.10f}\t{y:.10f}\t{z}\t{charge}")
+    # Keep identifiers unique so the key index sees distinct molecules
+    header = header.replace(header.split("\t")[0], f"gdb {idx}", 1)
+    smiles, inchi = ("\t".join(f"{key}.{idx}" for key in keys.rstrip("\t").split("\t")) for keys in (smiles, inchi))
+    return "\n".join([str(num_nodes), header, *atoms, frequencies, smiles, inchi]) + "\n"
+
+
+def synthetic_xyz_strs(num_molecules: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    return [synthetic_xyz_str(idx, rng) for idx in range(1, num_molecules + 1)]
+
+
+def write_synthetic_archive(xyz_strs: list[str], archive_path: Path):
+    write_archive(archive_path, {f"dsgdb9nsd_{idx:06d}.xyz": xyz_str for idx, xyz_str in enumerate(xyz_strs, start=1)})
+
+
+def reference_collate_data_dicts(data_dicts: list[dict[str, Optional[Tensor] | list[int]]]) -> dict[str, Optional[Tensor] | list[int]]:
+    # Per-sample implementation that collate_data_dicts replaced, kept as a baseline
+    segments = torch.cat([data_dict["segments"] for data_dict in data_dicts])
+    h = torch.cat([data_dict["h"] for data_dict in data_dicts], dim=0)
+    x = torch.cat([data_dict["x"] for data_dict in data_dicts], dim=0)
+    offsets = [0] + torch.cumsum(segments, dim=0).tolist()[:-1]
+    e = torch.cat([data_dict["e"] + offset for data_dict, offset in zip(data_dicts, offsets) if data_dict["e"] is not None], dim=1)
+    return {
+        "h": h,
+        "x": x,
+        "e": e,
+        "a": None,
+        "g": None,
+        "h_ctx": None,
+        "x_ctx": None,
+        "e_ctx": None,
+        "a_ctx": None,
+        "g_ctx": None,
+        "segments": segments,
+    }
+
+
+def measure(fn: Callable, repeat: int) -> list[float]:
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def result(name: str, times: list[float], num_items: int, **params) -> dict:
+    return {
+        "name": name,
+        "params": params,
+        "num_items": num_items,
+        "times": times,
+        "best": min(times),
+        "median": statistics.median(times),
+        "throughput": num_items / min(times),
+    }
+
+
+def run(num_molecules: int, batch_sizes: list[int], num_getitems: int, num_workers: int, repeat: int, seed: int, work_dir_path: Path) -> list[dict]:
+    results = []
+
+    xyz_strs = synthetic_xyz_strs(num_molecules, seed)
+    archive_path = work_dir_path / "dsgdb9nsd.xyz.tar.bz2"
+    write_synthetic_archive(xyz_strs, archive_path)
+
+    # Parsing a single molecule at a time
+    times = measure(lambda: [data_dict_from_xyz_str(xyz_str) for xyz_str in xyz_strs], repeat)
+    results.append(result("parse", times, num_molecules))
+
+    # Full build from the raw archive into a fresh cache directory every time
+    build_dir_paths = iter([work_dir_path / f"build-{i}" for i in range(repeat)])
+    times = measure(lambda: QM9Dataset(url=str(archive_path), dataset_dir_path=next(build_dir_paths), num_workers=num_workers), repeat)
+    results.append(result("build", times, num_molecules, num_workers=num_workers))
+
+    # Loading the cache written by the first build, the index alone and with every shard since shards open lazily
+    dataset_dir_path = work_dir_path / "build-0"
+
+    def load(mmap: bool) -> QM9Dataset:
+        dataset = QM9Dataset(url=str(archive_path), dataset_dir_path=dataset_dir_path, mmap=mmap)
+        for shard_idx in range(dataset.num_shards):
+            dataset.shard(shard_idx)
+        # Read the last molecule so memory mapped shards are touched too
+        dataset[len(dataset) - 1]
+        return dataset
+
+    for mmap in (False, True):
+        times = measure(lambda: QM9Dataset(url=str(archive_path), dataset_dir_path=dataset_dir_path, mmap=mmap), repeat)
+        results.append(result("load_index", times, num_molecules, mmap=mmap))
+        times = measure(lambda: load(mmap), repeat)
+        results.append(result("load", times, num_molecules, mmap=mmap))
+
+    # Random access into the loaded cache
+    generator = torch.Generator().manual_seed(seed)
+    for mmap in (False, True):
+        for widen in (True, False):
+            dataset = QM9Dataset(url=str(archive_path), dataset_dir_path=dataset_dir_path, mmap=mmap, widen=widen)
+            indices = torch.randint(0, len(dataset), (num_getitems,), generator=generator).tolist()
+            times = measure(lambda: [dataset[idx] for idx in indices], repeat)
+            results.append(result("getitem", times, num_getitems, mmap=mmap, widen=widen))
+
+    # Collating consecutive batches of the loaded cache, from widened or compact molecules, against the per-sample reference
+    for widen in (True, False):
+        dataset = QM9Dataset(url=str(archive_path), dataset_dir_path=dataset_dir_path, widen=widen)
+        data_dicts = [dataset[idx] for idx in range(len(dataset))]
+        for batch_size in batch_sizes:
+            batches = [data_dicts[start:start + batch_size] for start in range(0, len(data_dicts) - batch_size + 1, batch_size)]
+            if not batches:
+                continue
+            if widen:
+                times = measure(lambda: [reference_collate_data_dicts(batch) for batch in batches], repeat)
+                results.append(result("collate", times, len(batches) * batch_size, batch_size=batch_size, widen=widen, path="reference"))
+            times = measure(lambda: [collate_data_dicts(batch) for batch in batches], repeat)
+            results.append(result("collate", times, len(batches) * batch_size, batch_size=batch_size, widen=widen))
+
+    # Gathering and collating random batches end to end, molecule by molecule or straight from the packed arrays
+    dataset = QM9Dataset(url=str(archive_path), dataset_dir_path=dataset_dir_path)
+    permutation = torch.randperm(len(dataset), generator=generator)
+    for batch_size in batch_sizes:
+        batches = permutation[:len(dataset) // batch_size * batch_size].view(-1, batch_size).tolist()
+        if not batches:
+            continue
+        times = measure(lambda: [collate_data_dicts([dataset[idx] for idx in batch]) for batch in batches], repeat)
+        results.append(result("batch", times, len(batches) * batch_size, batch_size=batch_size, path="getitem"))
+        times = measure(lambda: [dataset.collate(batch) for batch in batches], repeat)
+        results.append(result("batch", times, len(batches) * batch_size, batch_size=batch_size, path="packed"))
+
+    return results
+
+
+def regressions_from_reports(results: list[dict], baseline_results: list[dict], tolerance: float) -> list[tuple[dict, float]]:
+    # Match entries by name and params and flag throughput drops beyond the tolerance
+    baseline_throughputs = {(entry["name"], json.dumps(entry["params"], sort_keys=True)): entry["throughput"] for entry in baseline_results}
+    regressions = []
+    for entry in results:
+        baseline_throughput = baseline_throughputs.get((entry["name"], json.dumps(entry["params"], sort_keys=True)))
+        if baseline_throughput is not None and entry["throughput"] < (1.0 - tolerance) * baseline_throughput:
+            regressions.append((entry, entry["throughput"] / baseline_throughput))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of parsing, building, loading, indexing and collating a synthetic QM9-like archive")
+    parser.add_argument("--num-molecules", type=int, default=10000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32, 128, 512])
+    parser.add_argument("--num-getitems", type=int, default=10000)
+    parser.add_argument("--num-workers", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, default=None, help="Write results as JSON to this path")
+    parser.add_argument("--baseline", type=Path, default=None, help="Compare against results previously written with --output")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative throughput drop against the baseline")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir_path:
+        results = run(args.num_molecules, args.batch_sizes, args.num_getitems, args.num_workers, args.repeat, args.seed, Path(work_dir_path))
+
+    print(f"{'benchmark':>10} {'params':>48} {'best (s)':>10} {'median (s)':>11} {'items/s':>12}")
+    for entry in results:
+        params = ",".join(f"{key}={value}" for key, value in entry["params"].items())
+        print(f"{entry['name']:>10} {params:>48} {entry['best']:>10.4f} {entry['median']:>11.4f} {entry['throughput']:>12.0f}")
+
+    if args.output is not None:
+        report = {
+            "metadata": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "python": platform.python_version(),
+                "torch": torch.__version__,
+                "platform": platform.platform(),
+                "num_threads": torch.get_num_threads(),
+            },
+            "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+            "results": results,
+        }
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline is not None:
+        regressions = regressions_from_reports(results, json.loads(args.baseline.read_text())["results"], args.tolerance)
+        for entry, ratio in regressions:
+            params = ",".join(f"{key}={value}" for key, value in entry["params"].items())
+            print(f"Regression in {entry['name']} {params}: {ratio:.2f}x of baseline throughput")
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
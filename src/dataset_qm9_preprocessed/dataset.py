@@ -1,84 +1,836 @@
-import tarfile
-import tempfile
+import bisect
+import contextlib
+import functools
+import hashlib
+import json
+import os
+import shutil
+import time
+import urllib.parse
+import warnings
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional
 
-import requests
 import torch
-from torch.utils.data import Dataset
+from torch import Tensor
+from torch.utils.data import Dataset, IterableDataset, Subset, get_worker_info
 
-from dataset_qm9_preprocessed.utils import data_dict_from_xyz_str
+from dataset_qm9_preprocessed.utils import KEY_NAMES, MISSING_KEY_HASH, PACKED_DATA_VERSION, center_positions, collate_packed_data, composition_columns, composition_mask, concat_packed_data, data_dict_from_packed_data, data_dict_from_xyz_str, element_counts_from_packed_data, element_masks_from_element_counts, gather_packed_data, gdb_table_from_gdb_ids, hash_table_from_key_hashes, indices_from_hash_table, key_hashes_from_strs, packed_data_from_xyz_strs, property_stats_from_properties, radius_edge_index_from_positions, slice_packed_data, write_xyz
 
 PROJECT_ROOT_PATH = Path(__file__).resolve().parent.parent
 
+DEFAULT_URL = "https://github.com/bondrewd/dataset-qm9-raw/raw/refs/heads/main/dsgdb9nsd.xyz.tar.bz2"
+
+DEFAULT_DATASET_DIR_PATH = PROJECT_ROOT_PATH / Path("../../../dataset")
+
+# Bump whenever parsing or preprocessing changes the cached values
+PREPROCESSING_VERSION = 3
+
+CHUNK_SIZE = 4096
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+
+# Upper bound on a server requested Retry-After delay
+MAX_RETRY_DELAY = 300.0
+
+# Bump whenever the split ordering changes
+SPLIT_VERSION = 1
+
+
+@dataclass
+class BuildReport:
+    cache_key: str
+    url: str
+    num_molecules: int = 0
+    stages: dict[str, dict[str, float | int]] = field(default_factory=dict)
+    skipped: list[dict[str, str]] = field(default_factory=list)
+    on_stage: Optional[Callable[[str, dict[str, float | int]], None]] = field(default=None, repr=False, compare=False)
+
+    @property
+    def num_skipped(self) -> int:
+        return len(self.skipped)
+
+    def record(self, name: str, seconds: float, num_bytes: int = 0, num_items: int = 0):
+        self.stages[name] = {"seconds": seconds, "bytes": num_bytes, "items": num_items}
+        # Forward every stage to the caller's telemetry as soon as it finishes
+        if self.on_stage is not None:
+            self.on_stage(name, self.stages[name])
+
+    def to_dict(self) -> dict:
+        report_dict = asdict(self)
+        del report_dict["on_stage"]
+        return report_dict
+
+    def save(self, path: Path):
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(json.dumps(self.to_dict(), indent=2))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "BuildReport":
+        return cls(**json.loads(path.read_text()))
+
+
+def default_split_sizes(num_molecules: int) -> dict[str, int]:
+    # 100k training molecules, 10% test and the rest for validation over every molecule in the cache. This is not the
+    # EGNN/Cormorant split (100000 / 17748 / 13083), which first drops the 3054 uncharacterized molecules
+    num_test = int(0.1 * num_molecules)
+    num_train = min(100000, num_molecules - num_test)
+    return {"train": num_train, "valid": num_molecules - num_train - num_test, "test": num_test}
+
+
+def permutation_from_seed(num_molecules: int, seed: int) -> Tensor:
+    # Order molecules by a hash of the seed and index so the permutation never depends on library versions
+    keys = [hashlib.blake2b(f"{seed}:{idx}".encode("utf-8"), digest_size=8).digest() for idx in range(num_molecules)]
+    return torch.tensor(sorted(range(num_molecules), key=keys.__getitem__), dtype=torch.int64)
+
+
+def cache_key_from_options(**options) -> str:
+    key_dict = {"packed_data_version": PACKED_DATA_VERSION, "preprocessing_version": PREPROCESSING_VERSION, **options}
+    return hashlib.sha256(json.dumps(key_dict, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def dataset_cache_key(url: str, sha256: Optional[str] = None, **options) -> str:
+    # Key the cache by the archive checksum when it is pinned, so every mirror shares one cache
+    source = url if sha256 is None else sha256.lower()
+    return cache_key_from_options(source=source, **options)
+
+
+def local_path_from_url(url: str) -> Optional[Path]:
+    # Treat file:// urls and plain paths as local mirrors
+    parsed_url = urllib.parse.urlparse(url)
+    if parsed_url.scheme == "file":
+        from urllib.request import url2pathname
+
+        return Path(url2pathname(parsed_url.path))
+    if parsed_url.scheme == "":
+        return Path(url)
+    return None
+
+
+def raw_data_path_from_url(url: str, dataset_dir_path: Path) -> Path:
+    # Local mirrors are read in place, remote archives are downloaded into the raw cache
+    local_path = local_path_from_url(url)
+    if local_path is not None:
+        return local_path
+    return Path(dataset_dir_path) / "raw" / (Path(urllib.parse.urlparse(url).path).name or "data.tar.bz2")
+
+
+def sha256_from_path(path: Path, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def retry_delay_from_headers(headers: dict[str, str], attempt: int) -> float:
+    # Honour Retry-After given in seconds or as an HTTP date, falling back to exponential backoff
+    retry_after = headers.get("Retry-After")
+    if retry_after is not None:
+        if retry_after.strip().isdigit():
+            return min(float(retry_after), MAX_RETRY_DELAY)
+        from email.utils import parsedate_to_datetime
+
+        try:
+            return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0), MAX_RETRY_DELAY)
+        except (TypeError, ValueError):
+            pass
+    return min(2 ** attempt, 30)
+
+
+def download_archive(url: str, path: Path, sha256: Optional[str] = None, timeout: float = 60.0, retries: int = 5, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    # Imported here so processes that only read the cache never pay for it
+    import requests
+
+    # Let a single process download the archive, the others wait for it and then reuse it
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(path.with_name(path.name + ".lock")):
+        # Skip the download if a previous one completed
+        if path.exists():
+            if sha256 is None or sha256_from_path(path) == sha256.lower():
+                return
+            path.unlink()
+
+        # Stream into a .part file, resuming with a range request after failures
+        part_path = path.with_name(path.name + ".part")
+        for attempt in range(retries + 1):
+            offset = part_path.stat().st_size if part_path.exists() else 0
+            headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+            try:
+                with requests.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                    if response.status_code == 416:
+                        # The part file is complete or larger than the remote file, start over
+                        part_path.unlink()
+                        continue
+                    # Client errors will not go away by retrying, except timeouts and rate limits
+                    if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+                        raise RuntimeError(f"Failed to download raw data from {url}: HTTP {response.status_code}")
+                    if response.status_code not in (200, 206):
+                        delay = retry_delay_from_headers(response.headers, attempt)
+                    else:
+                        delay = None
+                        # Servers that ignore the range send the whole file again
+                        mode = "ab" if response.status_code == 206 else "wb"
+                        with open(part_path, mode) as file:
+                            for chunk in response.iter_content(chunk_size=chunk_size):
+                                file.write(chunk)
+                if delay is None:
+                    break
+                if attempt == retries:
+                    raise RuntimeError(f"Failed to download raw data from {url}: HTTP {response.status_code}")
+                time.sleep(delay)
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                if attempt == retries:
+                    raise RuntimeError(f"Failed to download raw data from {url}") from e
+                time.sleep(min(2 ** attempt, 30))
+        else:
+            raise RuntimeError(f"Failed to download raw data from {url}")
+
+        # Verify before moving the archive into the raw cache
+        if sha256 is not None and sha256_from_path(part_path) != sha256.lower():
+            part_path.unlink()
+            raise RuntimeError(f"Checksum mismatch for raw data downloaded from {url}")
+        os.replace(part_path, path)
+
+
+def save_atomic(obj: object, path: Path):
+    import tempfile
+
+    # Write next to the destination and rename into place so readers never see a partial file
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            torch.save(obj, file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        Path(tmp_path).unlink(missing_ok=True)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    # Hold an exclusive lock on a file next to the cache, released by the OS even if the holder crashes
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "a+b") as file:
+        try:
+            import fcntl
+
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        except ImportError:
+            import msvcrt
+
+            # Windows only retries for a few seconds before giving up, so keep retrying until the lock is ours
+            file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        yield
+
+
+def xyz_members_from_archive(archive: Path | BinaryIO) -> Iterator[tuple[str, str]]:
+    import tarfile
+
+    # Read members sequentially so the archive is decompressed as a single stream, from a path or any readable stream
+    with tarfile.open(name=archive, mode="r|bz2") if isinstance(archive, (str, Path)) else tarfile.open(fileobj=archive, mode="r|bz2") as tar:
+        for member in tar:
+            if member.isfile() and member.name.endswith(".xyz"):
+                yield member.name, tar.extractfile(member).read().decode("utf-8")
+
+
+def preprocess_xyz_strs(xyz_strs: list[str], store_edges: bool = True, cutoff: Optional[float] = None, max_num_neighbors: Optional[int] = None) -> tuple[dict[str, int | Tensor], list[tuple[int, str]]]:
+    # Parse molecules, recording invalid ones with the reason they were skipped
+    skipped = []
+    packed_data = packed_data_from_xyz_strs(xyz_strs, on_error=lambda index, error: skipped.append((index, f"{type(error).__name__}: {error}")), store_edges=store_edges, cutoff=cutoff, max_num_neighbors=max_num_neighbors)
+
+    # Center positions of every molecule at once
+    packed_data["x"] = center_positions(packed_data["x"], packed_data["segments"])
+
+    return packed_data, skipped
+
+
+class GrowingFileReader:
+    def __init__(self, file: BinaryIO, done_path: Path, timeout: float = 60.0, poll_interval: float = 0.05):
+        # Read a file another process is still appending to, until done_path appears
+        self.file = file
+        self.done_path = done_path
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+
+    def read(self, size: int = -1) -> bytes:
+        deadline = time.monotonic() + self.timeout
+        while not (data := self.file.read(size)):
+            # The writer renames the file once complete, which leaves this handle on the same data
+            if self.done_path.exists():
+                return self.file.read(size)
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Timed out waiting for {self.done_path}")
+            time.sleep(self.poll_interval)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def prepare_cache(url: str, dataset_dir_path: str, sha256: Optional[str] = None, timeout: float = 60.0, build: bool = True, **options):
+    # Download the raw archive, then build the cache, meant to run in a process that outlives its starter
+    if local_path_from_url(url) is None:
+        download_archive(url, raw_data_path_from_url(url, dataset_dir_path), sha256=sha256, timeout=timeout)
+    if build:
+        QM9Dataset(url=url, dataset_dir_path=dataset_dir_path, sha256=sha256, timeout=timeout, **options)
+
 
 class QM9Dataset(Dataset):
-    def __init__(self, url: Optional[str] = None, dataset_dir_path: Optional[str] = None, force_download: bool = False):
+    def __init__(self, url: Optional[str] = None, dataset_dir_path: Optional[str] = None, force_download: bool = False, mmap: bool = False, num_workers: int = 0, store_edges: bool = True, sha256: Optional[str] = None, timeout: float = 60.0, retries: int = 5, shard_size: Optional[int] = None, cutoff: Optional[float] = None, max_num_neighbors: Optional[int] = None, widen: bool = True, on_build_stage: Optional[Callable[[str, dict[str, float | int]], None]] = None):
         if url is None:
-            self.url = "https://github.com/bondrewd/dataset-qm9-raw/raw/refs/heads/main/dsgdb9nsd.xyz.tar.bz2"
+            self.url = DEFAULT_URL
         else:
             self.url = url
 
         if dataset_dir_path is None:
-            self.dataset_dir_path = PROJECT_ROOT_PATH / Path("../../../dataset")
+            self.dataset_dir_path = DEFAULT_DATASET_DIR_PATH
         else:
             self.dataset_dir_path = Path(dataset_dir_path)
 
-        self.dataset_data_path = Path(self.dataset_dir_path / "dataset-qm9").with_suffix(".pth")
+        self.cache_key = dataset_cache_key(self.url, sha256, store_edges=store_edges, shard_size=shard_size, cutoff=cutoff, max_num_neighbors=max_num_neighbors)
+        self.dataset_data_path = self.dataset_dir_path / f"dataset-qm9-{self.cache_key}.pth"
+        self.dataset_shard_dir_path = self.dataset_data_path.with_suffix("")
 
-        if not self.dataset_data_path.exists() or force_download:
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                # Step 1: convert temp dir to a Path
-                tmp_dir_path = Path(tmp_dir)
+        self.mmap = mmap
+        self.store_edges = store_edges
+        self.shard_size = shard_size
+        self.cutoff = cutoff
+        self.max_num_neighbors = max_num_neighbors
+        self.widen = widen
 
-                # Step 2: download raw data
-                raw_data_path = tmp_dir_path / "data.tar.bz2"
-                if not raw_data_path.exists():
-                    response = requests.get(self.url)
-                    if response.status_code == 200:
-                        with open(raw_data_path, "wb") as file:
-                            file.write(response.content)
-                    else:
-                        raise RuntimeError(f"Failed to download raw data from {self.url}")
-
-                # Step 3: decompress raw data
-                raw_data_dir_path = tmp_dir_path / "raw"
-                if not raw_data_dir_path.exists():
-                    raw_data_dir_path.mkdir(parents=True, exist_ok=True)
-                    with tarfile.open(raw_data_path, "r:bz2") as tar:
-                        tar.extractall(path=raw_data_dir_path, filter="fully_trusted")
-
-                # Step 4: list .xyz files
-                xyz_file_paths = list(raw_data_dir_path.rglob("*.xyz"))
-                xyz_file_paths.sort()
-
-                # Step 5: build data dictionaries
-                self.data_dicts = []
-                for xyz_file_path in xyz_file_paths:
-                    try:
-                        with open(xyz_file_path, "r") as xyz_file:
-                            xyz_str = xyz_file.read()
-                        data_dict = data_dict_from_xyz_str(xyz_str)
-                        data_dict["x"] = data_dict["x"] - torch.mean(data_dict["x"], dim=0, keepdim=True)
-                        if data_dict["x_ctx"] is not None:
-                            data_dict["x_ctx"] = data_dict["x_ctx"] - torch.mean(data_dict["x_ctx"], dim=0, keepdim=True)
-                        self.data_dicts.append(data_dict)
-                    except Exception as e:
-                        if isinstance(e, (KeyboardInterrupt, SystemExit)):
-                            raise
-                        continue
+        self.dataset_report_path = self.dataset_data_path.with_suffix(".report.json")
+        self.dataset_keys_path = self.dataset_data_path.with_suffix(".keys.pth")
+        self.dataset_lock_path = self.dataset_data_path.with_suffix(".lock")
 
-                # Step 6: save data dictionaries
-                self.dataset_dir_path.mkdir(parents=True, exist_ok=True)
-                torch.save(self.data_dicts, self.dataset_data_path)
+        self.build_report = None
+
+        self.packed_data = None if force_download else self.load_index()
+        if self.packed_data is None:
+            # Let a single process build the cache, the others wait for it and then read its result
+            with file_lock(self.dataset_lock_path):
+                self.packed_data = None if force_download else self.load_index()
+                if self.packed_data is None:
+                    self.build(force_download=force_download, num_workers=num_workers, sha256=sha256, timeout=timeout, retries=retries, on_build_stage=on_build_stage)
+        if self.build_report is None and self.dataset_report_path.exists():
+            self.build_report = BuildReport.load(self.dataset_report_path)
+
+        # The cache file only holds the global index, shards are opened on first access
+        self.shard_offsets = self.packed_data["shard_offsets"].tolist()
+        self.shards = {}
+        self.key_tables = None
+
+    def load_index(self) -> Optional[dict[str, int | Tensor]]:
+        if not self.dataset_data_path.exists():
+            return None
+        packed_data = torch.load(self.dataset_data_path, weights_only=True, mmap=self.mmap)
+        # Discard caches written in an older format
+        if not isinstance(packed_data, dict) or packed_data.get("version") != PACKED_DATA_VERSION:
+            return None
+        # Discard indexes whose shards are gone, so an interrupted or damaged cache is rebuilt instead of failing on access
+        shard_dir_path = self.dataset_shard_dir_path / packed_data["shard_dir"]
+        if not all((shard_dir_path / f"shard-{i:05d}.pth").exists() for i in range(packed_data["shard_offsets"].shape[0] - 1)):
+            return None
+        return packed_data
+
+    def build(self, force_download: bool = False, num_workers: int = 0, sha256: Optional[str] = None, timeout: float = 60.0, retries: int = 5, on_build_stage: Optional[Callable[[str, dict[str, float | int]], None]] = None):
+        self.build_report = BuildReport(cache_key=self.cache_key, url=self.url, on_stage=on_build_stage)
+
+        # Step 1: locate the raw archive, reading local mirrors in place
+        start = time.perf_counter()
+        raw_data_path = raw_data_path_from_url(self.url, self.dataset_dir_path)
+        if local_path_from_url(self.url) is not None:
+            if sha256 is not None and sha256_from_path(raw_data_path) != sha256.lower():
+                raise RuntimeError(f"Checksum mismatch for raw data at {raw_data_path}")
         else:
-            self.data_dicts = torch.load(self.dataset_data_path, weights_only=True)
+            # Step 2: download raw data into the persistent raw cache, reusing a verified archive even when forced
+            if force_download and sha256 is None:
+                raw_data_path.unlink(missing_ok=True)
+            download_archive(self.url, raw_data_path, sha256=sha256, timeout=timeout, retries=retries)
+        self.build_report.record("download", time.perf_counter() - start, raw_data_path.stat().st_size, 1)
+
+        # Step 3: stream .xyz members out of the archive without extracting them
+        start = time.perf_counter()
+        xyz_members = list(xyz_members_from_archive(raw_data_path))
+
+        # Step 4: sort members by name
+        xyz_members.sort(key=lambda xyz_member: xyz_member[0])
+        xyz_names = [xyz_name for xyz_name, _ in xyz_members]
+        xyz_strs = [xyz_str for _, xyz_str in xyz_members]
+        del xyz_members
+        self.build_report.record("decompress", time.perf_counter() - start, sum(len(xyz_str) for xyz_str in xyz_strs), len(xyz_strs))
+
+        # Step 5: build packed data chunk by chunk, reusing chunks saved by an interrupted build
+        start = time.perf_counter()
+        chunk_dir_path = self.dataset_data_path.with_suffix(".partial")
+        if force_download:
+            shutil.rmtree(chunk_dir_path, ignore_errors=True)
+        chunk_dir_path.mkdir(parents=True, exist_ok=True)
+        chunk_ranges = [(start, min(start + CHUNK_SIZE, len(xyz_strs))) for start in range(0, len(xyz_strs), CHUNK_SIZE)] or [(0, 0)]
+        chunk_paths = [chunk_dir_path / f"chunk-{start:06d}-{end:06d}.pth" for start, end in chunk_ranges]
+        chunks = {i: torch.load(chunk_path, weights_only=True) for i, chunk_path in enumerate(chunk_paths) if chunk_path.exists()}
+        preprocess = functools.partial(preprocess_xyz_strs, store_edges=self.store_edges, cutoff=self.cutoff, max_num_neighbors=self.max_num_neighbors)
+        missing_chunks = [i for i in range(len(chunk_paths)) if i not in chunks]
+        if num_workers > 0:
+            from concurrent.futures import ProcessPoolExecutor, as_completed
+
+            # Split the missing chunks across a process pool, saving each one as soon as it is ready
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = {executor.submit(preprocess, xyz_strs[chunk_ranges[i][0]:chunk_ranges[i][1]]): i for i in missing_chunks}
+                for future in as_completed(futures):
+                    chunks[futures[future]] = future.result()
+                    save_atomic(chunks[futures[future]], chunk_paths[futures[future]])
+        else:
+            for i in missing_chunks:
+                chunks[i] = preprocess(xyz_strs[chunk_ranges[i][0]:chunk_ranges[i][1]])
+                save_atomic(chunks[i], chunk_paths[i])
+        num_bytes = sum(len(xyz_str) for xyz_str in xyz_strs)
+        del xyz_strs
+
+        # Map chunk-local indices of skipped molecules back to archive members
+        for i in range(len(chunk_paths)):
+            for index, reason in chunks[i][1]:
+                self.build_report.skipped.append({"name": xyz_names[chunk_ranges[i][0] + index], "reason": reason})
+        self.build_report.record("parse", time.perf_counter() - start, num_bytes, len(xyz_names) - self.build_report.num_skipped)
+
+        # Step 6: merge chunks in order
+        start = time.perf_counter()
+        self.packed_data = concat_packed_data([chunks[i][0] for i in range(len(chunk_paths))])
+        del chunks
+
+        # Step 7: compute normalization statistics of graph properties and the per-molecule composition table
+        if "g" in self.packed_data and not torch.isnan(self.packed_data["g"]).any(dim=1).all():
+            self.packed_data["property_stats"] = property_stats_from_properties(self.packed_data["g"])
+        element_counts = element_counts_from_packed_data(self.packed_data)
+        self.build_report.num_molecules = len(self)
+        self.build_report.record("merge", time.perf_counter() - start, 0, len(self))
+
+        # Step 8: save the gdb id, SMILES and InChI hash tables apart from the molecules
+        start = time.perf_counter()
+        key_index = {
+            "version": PACKED_DATA_VERSION,
+            **{key: self.packed_data.pop(key) for key in KEY_NAMES},
+        }
+        key_index["gdb_table"] = gdb_table_from_gdb_ids(key_index["gdb_ids"])
+        key_index["smiles_table"] = hash_table_from_key_hashes(key_index["smiles_hashes"])
+        key_index["inchi_table"] = hash_table_from_key_hashes(key_index["inchi_hashes"])
+        save_atomic(key_index, self.dataset_keys_path)
+        self.build_report.record("index", time.perf_counter() - start, self.dataset_keys_path.stat().st_size, len(self))
+
+        # Step 9: save molecules as fixed-size shards, a single one by default, followed by a small global index
+        start = time.perf_counter()
+        saved_paths = [self.dataset_data_path]
+
+        # Write into a directory of this build only, so processes reading the shards of the current index keep them
+        self.dataset_shard_dir_path.mkdir(parents=True, exist_ok=True)
+        current_packed_data = self.load_index()
+        for path in self.dataset_shard_dir_path.iterdir():
+            if current_packed_data is None or path.name != current_packed_data["shard_dir"]:
+                shutil.rmtree(path, ignore_errors=True)
+        shard_dir_path = self.dataset_shard_dir_path / f"build-{time.time_ns()}-{os.getpid()}"
+        shard_dir_path.mkdir()
+        shard_offsets = list(range(0, len(self), self.shard_size or max(len(self), 1))) + [len(self)]
+        for i, (shard_start, shard_end) in enumerate(zip(shard_offsets[:-1], shard_offsets[1:])):
+            shard = slice_packed_data(self.packed_data, shard_start, shard_end)
+            # Clone partial views so each shard only serializes its own molecules
+            if shard_end - shard_start < len(self):
+                shard = {key: value.clone() if isinstance(value, Tensor) else value for key, value in shard.items()}
+            save_atomic(shard, shard_dir_path / f"shard-{i:05d}.pth")
+            saved_paths.append(shard_dir_path / f"shard-{i:05d}.pth")
+        self.packed_data = {
+            "version": PACKED_DATA_VERSION,
+            "shard_dir": shard_dir_path.name,
+            "segments": self.packed_data["segments"],
+            "shard_offsets": torch.tensor(shard_offsets, dtype=torch.int64),
+            "element_counts": element_counts,
+            "element_masks": element_masks_from_element_counts(element_counts),
+            **{key: self.packed_data[key] for key in ("g", "property_stats") if key in self.packed_data},
+        }
+        save_atomic(self.packed_data, self.dataset_data_path)
+        shutil.rmtree(chunk_dir_path, ignore_errors=True)
+        self.build_report.record("save", time.perf_counter() - start, sum(path.stat().st_size for path in saved_paths), len(saved_paths))
+
+        # Step 10: reopen the saved cache memory-mapped so every process shares one page-cache copy
+        if self.mmap:
+            self.packed_data = torch.load(self.dataset_data_path, weights_only=True, mmap=True)
+
+        # Step 11: save the build report next to the cache
+        self.build_report.save(self.dataset_report_path)
 
     def __len__(self):
-        return len(self.data_dicts)
+        return self.packed_data["segments"].shape[0]
+
+    def split(self, sizes: Optional[dict[str, int | float]] = None, seed: int = 0) -> dict[str, "QM9Subset"]:
+        # Convert fractions into sizes, defaulting to 100k training molecules and 10% test
+        if sizes is None:
+            sizes = default_split_sizes(len(self))
+        sizes = {name: int(size * len(self)) if isinstance(size, float) else size for name, size in sizes.items()}
+        if sum(sizes.values()) > len(self):
+            raise ValueError(f"Split sizes {sizes} exceed {len(self)} molecules")
+
+        # Reuse index files saved next to the cache so every process sees the same split
+        split_key = cache_key_from_options(split_version=SPLIT_VERSION, sizes=sizes, seed=seed, num_molecules=len(self))
+        split_path = self.dataset_data_path.with_suffix(f".split-{split_key}.pth")
+        if split_path.exists():
+            indices = torch.load(split_path, weights_only=True)["indices"]
+        else:
+            permutation = permutation_from_seed(len(self), seed)
+            offsets = [0] + torch.cumsum(torch.tensor(list(sizes.values())), dim=0).tolist()
+            indices = {name: permutation[start:end].clone() for name, start, end in zip(sizes, offsets[:-1], offsets[1:])}
+            save_atomic({"version": SPLIT_VERSION, "seed": seed, "sizes": sizes, "indices": indices}, split_path)
+
+        return {name: QM9Subset(self, indices[name]) for name in sizes}
+
+    @property
+    def num_nodes(self) -> Tensor:
+        return self.packed_data["segments"]
+
+    @property
+    def properties(self) -> Optional[Tensor]:
+        return self.packed_data.get("g")
+
+    @property
+    def property_stats(self) -> Optional[dict[str, Tensor]]:
+        return self.packed_data.get("property_stats")
+
+    @property
+    def element_counts(self) -> Tensor:
+        return self.packed_data["element_counts"]
+
+    @property
+    def element_masks(self) -> Tensor:
+        return self.packed_data["element_masks"]
+
+    def composition(self) -> dict[str, Tensor]:
+        return composition_columns(self.element_counts)
+
+    def select(
+        self,
+        predicate: Optional[Callable[[dict[str, Tensor]], Tensor]] = None,
+        formula: Optional[str] = None,
+        include_elements: Optional[Iterable[str]] = None,
+        exclude_elements: Optional[Iterable[str]] = None,
+        min_num_heavy_atoms: Optional[int] = None,
+        max_num_heavy_atoms: Optional[int] = None,
+    ) -> "QM9Subset":
+        # Filter on the composition table only, without opening any shard
+        mask = composition_mask(self.element_counts, self.element_masks, predicate, formula, include_elements, exclude_elements, min_num_heavy_atoms, max_num_heavy_atoms)
+        return QM9Subset(self, torch.nonzero(mask).flatten())
+
+    @property
+    def num_shards(self) -> int:
+        return len(self.shard_offsets) - 1
+
+    def shard(self, shard_idx: int) -> dict[str, int | Tensor]:
+        if shard_idx not in self.shards:
+            self.shards[shard_idx] = torch.load(self.dataset_shard_dir_path / self.packed_data["shard_dir"] / f"shard-{shard_idx:05d}.pth", weights_only=True, mmap=self.mmap)
+        return self.shards[shard_idx]
+
+    def key_index(self) -> dict[str, int | Tensor]:
+        # The key index is only read on the first lookup
+        if self.key_tables is None:
+            self.key_tables = torch.load(self.dataset_keys_path, weights_only=True, mmap=self.mmap)
+        return self.key_tables
+
+    def indices_of(self, gdb_ids: Optional[Iterable[int] | Tensor] = None, smiles: Optional[Iterable[str]] = None, inchi: Optional[Iterable[str]] = None) -> Tensor:
+        if sum(keys is not None for keys in (gdb_ids, smiles, inchi)) != 1:
+            raise ValueError("Exactly one of gdb_ids, smiles or inchi is required")
+
+        # Look up a batch of keys at once, returning the lowest matching molecule index or -1
+        key_index = self.key_index()
+        if gdb_ids is not None:
+            gdb_ids = torch.as_tensor(gdb_ids, dtype=torch.int64)
+            in_range = (gdb_ids >= 0) & (gdb_ids < key_index["gdb_table"].shape[0])
+            indices = torch.full(gdb_ids.shape, -1, dtype=torch.int64)
+            indices[in_range] = key_index["gdb_table"][gdb_ids[in_range]].to(torch.int64)
+            return indices
+        if smiles is not None:
+            return indices_from_hash_table(key_index["smiles_table"], key_index["smiles_hashes"], key_hashes_from_strs(smiles))
+        return indices_from_hash_table(key_index["inchi_table"], key_index["inchi_hashes"], key_hashes_from_strs(inchi))
+
+    def contains(self, gdb_ids: Optional[Iterable[int] | Tensor] = None, smiles: Optional[Iterable[str]] = None, inchi: Optional[Iterable[str]] = None) -> Tensor:
+        return self.indices_of(gdb_ids=gdb_ids, smiles=smiles, inchi=inchi) >= 0
+
+    def index_of(self, gdb_id: Optional[int] = None, smiles: Optional[str] = None, inchi: Optional[str] = None) -> Optional[int]:
+        idx = self.indices_of(
+            gdb_ids=None if gdb_id is None else [gdb_id],
+            smiles=None if smiles is None else [smiles],
+            inchi=None if inchi is None else [inchi],
+        ).item()
+        return None if idx < 0 else idx
+
+    def lookup_key(self, name: str, key: str) -> list[int]:
+        # Follow the probe sequence of the key, collecting every molecule sharing it
+        key_index = self.key_index()
+        table = key_index[f"{name}_table"]
+        key_hash = key_hashes_from_strs([key]).item()
+        indices = []
+        if key_hash == MISSING_KEY_HASH:
+            return indices
+        slot = key_hash & (table.shape[0] - 1)
+        while (idx := table[slot].item()) >= 0:
+            if key_index[f"{name}_hashes"][idx].item() == key_hash:
+                indices.append(idx)
+            slot = (slot + 1) & (table.shape[0] - 1)
+        return indices
+
+    def lookup_smiles(self, smiles: str) -> list[int]:
+        return self.lookup_key("smiles", smiles)
+
+    def lookup_inchi(self, inchi: str) -> list[int]:
+        return self.lookup_key("inchi", inchi)
+
+    @property
+    def gdb_ids(self) -> Tensor:
+        return self.key_index()["gdb_ids"]
+
+    def packed_slices(self, start: int = 0, end: Optional[int] = None, batch_size: int = CHUNK_SIZE) -> Iterator[dict[str, int | Tensor]]:
+        # Yield views of consecutive molecules, never crossing a shard boundary
+        end = len(self) if end is None else end
+        for shard_idx in range(self.num_shards):
+            shard_start, shard_end = self.shard_offsets[shard_idx], self.shard_offsets[shard_idx + 1]
+            for slice_start in range(max(start, shard_start), min(end, shard_end), batch_size):
+                slice_end = min(slice_start + batch_size, end, shard_end)
+                yield slice_packed_data(self.shard(shard_idx), slice_start - shard_start, slice_end - shard_start)
+
+    def export_xyz(self, path: str | Path, start: int = 0, end: Optional[int] = None, batch_size: int = CHUNK_SIZE) -> int:
+        return write_xyz(self.packed_slices(start, end, batch_size), path)
 
     def __getitem__(self, idx):
-        return self.data_dicts[idx]
+        # Normalize index
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"Index {idx} out of range for {len(self)} molecules")
+
+        # Find the shard holding the molecule
+        shard_idx = bisect.bisect_right(self.shard_offsets, idx) - 1
+        data_dict = data_dict_from_packed_data(self.shard(shard_idx), idx - self.shard_offsets[shard_idx], widen=self.widen)
+
+        # Radius graphs are only precomputed with stored edges, otherwise filter the template on access
+        if self.cutoff is not None and not self.store_edges and data_dict["e"] is not None:
+            data_dict["e"] = radius_edge_index_from_positions(data_dict["x"], data_dict["e"], self.cutoff, self.max_num_neighbors)
+
+        return data_dict
+
+    def collate(self, indices: Tensor | list[int], dtype: Optional[torch.dtype] = None) -> dict[str, Optional[Tensor] | list[int]]:
+        # Normalize indices
+        indices = torch.as_tensor(indices, dtype=torch.int64)
+        indices = torch.where(indices < 0, indices + len(self), indices)
+        if indices.shape[0] > 0 and (int(indices.min()) < 0 or int(indices.max()) >= len(self)):
+            raise IndexError(f"Index out of range for {len(self)} molecules")
+
+        # Collate straight from the shard when the whole batch lives in one
+        shard_indices = torch.bucketize(indices, torch.tensor(self.shard_offsets[1:]), right=True)
+        unique_shard_indices = torch.unique(shard_indices).tolist()
+        if len(unique_shard_indices) <= 1:
+            shard_idx = unique_shard_indices[0] if unique_shard_indices else 0
+            packed_data = self.shard(shard_idx)
+            indices = indices - self.shard_offsets[shard_idx]
+        else:
+            # Otherwise gather the molecules of every shard into one packed data, then collate them in batch order
+            packed_data = concat_packed_data([gather_packed_data(self.shard(shard_idx), indices[shard_indices == shard_idx] - self.shard_offsets[shard_idx]) for shard_idx in unique_shard_indices])
+            order = torch.argsort(shard_indices, stable=True)
+            indices = torch.empty_like(order)
+            indices[order] = torch.arange(order.shape[0])
+
+        # Radius graphs are only precomputed with stored edges, otherwise filter the templates of the batch at once
+        cutoff = self.cutoff if not self.store_edges else None
+        return collate_packed_data(packed_data, indices, cutoff=cutoff, max_num_neighbors=self.max_num_neighbors, dtype=dtype)
+
+
+class QM9Subset(Subset):
+    def __init__(self, dataset: QM9Dataset, indices: Tensor):
+        # Keep indices as a tensor so subsets stay views over the parent's packed data
+        super().__init__(dataset, indices)
+
+    @property
+    def num_nodes(self) -> Tensor:
+        return self.dataset.num_nodes[self.indices]
+
+    @property
+    def properties(self) -> Optional[Tensor]:
+        properties = self.dataset.properties
+        return None if properties is None else properties[self.indices]
+
+    @property
+    def element_counts(self) -> Tensor:
+        return self.dataset.element_counts[self.indices]
+
+    @property
+    def element_masks(self) -> Tensor:
+        return self.dataset.element_masks[self.indices]
+
+    def composition(self) -> dict[str, Tensor]:
+        return composition_columns(self.element_counts)
+
+    def select(
+        self,
+        predicate: Optional[Callable[[dict[str, Tensor]], Tensor]] = None,
+        formula: Optional[str] = None,
+        include_elements: Optional[Iterable[str]] = None,
+        exclude_elements: Optional[Iterable[str]] = None,
+        min_num_heavy_atoms: Optional[int] = None,
+        max_num_heavy_atoms: Optional[int] = None,
+    ) -> "QM9Subset":
+        mask = composition_mask(self.element_counts, self.element_masks, predicate, formula, include_elements, exclude_elements, min_num_heavy_atoms, max_num_heavy_atoms)
+        return QM9Subset(self.dataset, self.indices[mask])
+
+    def __getitem__(self, idx):
+        return self.dataset[int(self.indices[idx])]
+
+    def __getitems__(self, indices: list[int]) -> list[dict[str, Optional[Tensor] | list[int]]]:
+        return [self.dataset[idx] for idx in self.indices[indices].tolist()]
+
+    def collate(self, indices: Tensor | list[int], dtype: Optional[torch.dtype] = None) -> dict[str, Optional[Tensor] | list[int]]:
+        return self.dataset.collate(self.indices[torch.as_tensor(indices, dtype=torch.int64)], dtype=dtype)
+
+
+class QM9StreamingDataset(IterableDataset):
+    def __init__(self, url: Optional[str] = None, dataset_dir_path: Optional[str] = None, shuffle_buffer_size: int = 0, seed: int = 0, store_edges: bool = True, cutoff: Optional[float] = None, max_num_neighbors: Optional[int] = None, sha256: Optional[str] = None, timeout: float = 60.0, write_cache: bool = True):
+        self.url = DEFAULT_URL if url is None else url
+        self.dataset_dir_path = DEFAULT_DATASET_DIR_PATH if dataset_dir_path is None else Path(dataset_dir_path)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+        self.store_edges = store_edges
+        self.cutoff = cutoff
+        self.max_num_neighbors = max_num_neighbors
+        self.sha256 = sha256
+        self.timeout = timeout
+        self.write_cache = write_cache
+
+        # Same cache as the QM9Dataset built with these options
+        self.cache_key = dataset_cache_key(self.url, sha256, store_edges=store_edges, shard_size=None, cutoff=cutoff, max_num_neighbors=max_num_neighbors)
+        self.dataset_data_path = self.dataset_dir_path / f"dataset-qm9-{self.cache_key}.pth"
+        self.dataset_log_path = self.dataset_data_path.with_suffix(".build.log")
+        self.is_local = local_path_from_url(self.url) is not None
+        self.raw_data_path = raw_data_path_from_url(self.url, self.dataset_dir_path)
+
+        self.build_process = None
+        self.skipped = []
+        self.verified = False
+
+    def __getstate__(self) -> dict:
+        # Process handles stay with the process that started them
+        return {**self.__dict__, "build_process": None}
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def dataset(self) -> QM9Dataset:
+        return QM9Dataset(url=self.url, dataset_dir_path=self.dataset_dir_path, store_edges=self.store_edges, cutoff=self.cutoff, max_num_neighbors=self.max_num_neighbors, sha256=self.sha256, timeout=self.timeout)
+
+    def start_build(self):
+        import subprocess
+        import sys
+
+        # Download and build in a detached process that outlives the DataLoader worker starting it
+        if self.build_process is not None and self.build_process.poll() is None:
+            return
+        options = {
+            "url": self.url,
+            "dataset_dir_path": str(self.dataset_dir_path),
+            "sha256": self.sha256,
+            "timeout": self.timeout,
+            "build": self.write_cache,
+            "store_edges": self.store_edges,
+            "cutoff": self.cutoff,
+            "max_num_neighbors": self.max_num_neighbors,
+        }
+        code = "import json, sys; from dataset_qm9_preprocessed.dataset import prepare_cache; prepare_cache(**json.loads(sys.argv[1]))"
+        env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [str(PROJECT_ROOT_PATH), os.environ.get("PYTHONPATH")]))}
+        self.dataset_dir_path.mkdir(parents=True, exist_ok=True)
+        with open(self.dataset_log_path, "ab") as log_file:
+            self.build_process = subprocess.Popen([sys.executable, "-c", code, json.dumps(options)], stdin=subprocess.DEVNULL, stdout=log_file, stderr=log_file, env=env, start_new_session=True)
+
+    def open_archive(self) -> BinaryIO:
+        # Read the raw archive once complete, or follow the .part file the download process is still appending to
+        part_path = self.raw_data_path.with_name(self.raw_data_path.name + ".part")
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                archive = open(self.raw_data_path, "rb")
+            except FileNotFoundError:
+                pass
+            else:
+                # Complete archives, local mirrors included, are checked once before streaming, the .part file is checked by the download
+                if self.sha256 is not None and not self.verified:
+                    if sha256_from_path(self.raw_data_path) != self.sha256.lower():
+                        archive.close()
+                        raise RuntimeError(f"Checksum mismatch for raw data at {self.raw_data_path}")
+                    self.verified = True
+                return archive
+            try:
+                return GrowingFileReader(open(part_path, "rb"), self.raw_data_path, timeout=self.timeout)
+            except FileNotFoundError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Timed out waiting for raw data at {self.raw_data_path}")
+            time.sleep(0.05)
+
+    def molecules(self, worker_id: int, num_workers: int) -> Iterator[dict[str, Optional[Tensor] | list[int]]]:
+        # Serve from the cache once it has been written
+        if self.dataset_data_path.exists():
+            dataset = self.dataset()
+            for idx in range(worker_id, len(dataset), num_workers):
+                yield dataset[idx]
+            return
+
+        # Otherwise the first worker starts the single download and the cache build, and every worker streams the archive
+        if worker_id == 0 and (self.write_cache or not self.is_local):
+            self.start_build()
+        archive = self.open_archive()
+
+        try:
+            skipped = []
+            for i, (xyz_name, xyz_str) in enumerate(xyz_members_from_archive(archive)):
+                # Split molecules across workers, each one parsing only its own share
+                if i % num_workers != worker_id:
+                    continue
+                try:
+                    data_dict = data_dict_from_xyz_str(xyz_str, cutoff=self.cutoff, max_num_neighbors=self.max_num_neighbors)
+                except Exception as e:
+                    skipped.append({"name": xyz_name, "reason": f"{type(e).__name__}: {e}"})
+                    continue
+                data_dict["x"] = center_positions(data_dict["x"], data_dict["segments"])
+                yield data_dict
+        finally:
+            archive.close()
+
+        # Report invalid molecules like the build report does, warning since workers cannot hand them back
+        self.skipped = skipped
+        if skipped:
+            warnings.warn(f"Skipped {len(skipped)} invalid molecules while streaming {self.url}, first {skipped[0]['name']}: {skipped[0]['reason']}")
+
+    def __iter__(self) -> Iterator[dict[str, Optional[Tensor] | list[int]]]:
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        molecules = self.molecules(worker_id, num_workers)
+        if self.shuffle_buffer_size <= 1:
+            yield from molecules
+            return
+
+        # Yield a random molecule from a bounded buffer, refilling it from the stream
+        generator = torch.Generator().manual_seed(self.seed + self.epoch * num_workers + worker_id)
+        buffer = []
+        for data_dict in molecules:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(data_dict)
+                continue
+            i = int(torch.randint(len(buffer), (1,), generator=generator))
+            yield buffer[i]
+            buffer[i] = data_dict
+        for i in torch.randperm(len(buffer), generator=generator).tolist():
+            yield buffer[i]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+
+import torch
+from torch import Tensor
+from torch.utils.data import BatchSampler, SequentialSampler
+
+from dataset_qm9_preprocessed.dataset import QM9Dataset
+from dataset_qm9_preprocessed.utils import collate_data_dicts
+
+PIN_MEMORY_KEYS = ("h", "x", "e", "segments")
+
+
+class QM9PrefetchLoader:
+    def __init__(
+        self,
+        dataset: QM9Dataset,
+        batch_sampler: Optional[Iterable[list[int]]] = None,
+        batch_size: int = 1,
+        collate_fn: Callable = collate_data_dicts,
+        prefetch: int = 2,
+        pin_memory: Optional[bool] = None,
+        device: Optional[torch.device | str] = None,
+        non_blocking: bool = True,
+    ):
+        if prefetch < 1:
+            raise ValueError(f"Invalid prefetch {prefetch}")
+
+        self.dataset = dataset
+        if batch_sampler is None:
+            self.batch_sampler = BatchSampler(SequentialSampler(dataset), batch_size=batch_size, drop_last=False)
+        else:
+            self.batch_sampler = batch_sampler
+        self.collate_fn = collate_fn
+        self.prefetch = prefetch
+        # Pinning needs an accelerator, so only enable it by default when CUDA is present
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self.device = None if device is None else torch.device(device)
+        self.non_blocking = non_blocking
+
+        self.batch_queue = None
+        self.num_batches = 0
+        self.num_stalls = 0
+        self.stall_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return 0 if self.batch_queue is None else self.batch_queue.qsize()
+
+    def set_epoch(self, epoch: int):
+        if hasattr(self.batch_sampler, "set_epoch"):
+            self.batch_sampler.set_epoch(epoch)
+
+    def produce(self, batch_queue: queue.Queue, stop_event: threading.Event):
+        def put(item) -> bool:
+            # Wake up regularly so an abandoned iteration can stop the thread
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for batch in self.batch_sampler:
+                # Collate straight from the packed arrays unless a custom collate function needs the molecules
+                if self.collate_fn is collate_data_dicts and hasattr(self.dataset, "collate"):
+                    data_dict = self.dataset.collate(batch)
+                else:
+                    data_dict = self.collate_fn([self.dataset[idx] for idx in batch])
+                if self.pin_memory:
+                    data_dict = {key: value.pin_memory() if key in PIN_MEMORY_KEYS and isinstance(value, Tensor) else value for key, value in data_dict.items()}
+                if not put(data_dict):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+
+    def get(self, thread: threading.Thread) -> object:
+        # Wake up regularly so a producer that died without queueing its error cannot hang the iteration
+        while True:
+            try:
+                return self.batch_queue.get(timeout=0.1)
+            except queue.Empty:
+                if not thread.is_alive() and self.batch_queue.empty():
+                    raise RuntimeError("Batch producer stopped without finishing the epoch")
+
+    def to_device(self, data_dict: dict[str, Optional[Tensor] | list[int]]) -> dict[str, Optional[Tensor] | list[int]]:
+        if self.device is None:
+            return data_dict
+        return {key: value.to(self.device, non_blocking=self.non_blocking) if isinstance(value, Tensor) else value for key, value in data_dict.items()}
+
+    def __iter__(self) -> Iterator[dict[str, Optional[Tensor] | list[int]]]:
+        self.batch_queue = queue.Queue(maxsize=self.prefetch)
+        self.num_batches = 0
+        self.num_stalls = 0
+        self.stall_time = 0.0
+
+        # Collate on a background thread that keeps up to prefetch batches queued ahead
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self.produce, args=(self.batch_queue, stop_event), daemon=True)
+        thread.start()
+        try:
+            while True:
+                # Count the time spent waiting on an empty queue as a stall
+                stalled = self.batch_queue.empty()
+                start = time.perf_counter()
+                item = self.get(thread)
+                if stalled:
+                    self.num_stalls += 1
+                    self.stall_time += time.perf_counter() - start
+
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                self.num_batches += 1
+                yield self.to_device(item)
+        finally:
+            stop_event.set()
+            thread.join()
+
+    def __len__(self) -> int:
+        return len(self.batch_sampler)
@@ -0,0 +1,161 @@
+import bisect
+import math
+from typing import Iterator, Optional
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+from dataset_qm9_preprocessed.dataset import QM9Dataset
+
+
+class QM9BatchSampler(Sampler[list[int]]):
+    def __init__(
+        self,
+        dataset: QM9Dataset,
+        max_num_nodes: Optional[int] = None,
+        max_num_edges: Optional[int] = None,
+        max_batch_size: Optional[int] = None,
+        bucket_width: int = 1,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        if max_num_nodes is None and max_num_edges is None and max_batch_size is None:
+            raise ValueError("At least one of max_num_nodes, max_num_edges or max_batch_size is required")
+        if bucket_width < 1:
+            raise ValueError(f"Invalid bucket width {bucket_width}")
+
+        self.max_num_nodes = max_num_nodes
+        self.max_num_edges = max_num_edges
+        self.max_batch_size = max_batch_size
+        self.bucket_width = bucket_width
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # Precompute per-molecule costs and size buckets from the atom-count index
+        self.num_nodes = dataset.num_nodes.to(torch.int64)
+        self.num_edges = self.num_nodes * (self.num_nodes - 1)
+        bucket_ids = (self.num_nodes - 1) // bucket_width
+        self.buckets = [torch.nonzero(bucket_ids == bucket_id).flatten() for bucket_id in torch.unique(bucket_ids).tolist()]
+
+        # Batches of the last (seed, epoch), so len() does not rebuild them
+        self.cached_batches_key = None
+        self.cached_batches = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.cached_batches_key = None
+        self.cached_batches = None
+
+    def batches(self) -> list[list[int]]:
+        if self.cached_batches_key != (self.seed, self.epoch):
+            self.cached_batches = self.build_batches()
+            self.cached_batches_key = (self.seed, self.epoch)
+        return self.cached_batches
+
+    def build_batches(self) -> list[list[int]]:
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+
+        batches = []
+        for bucket in self.buckets:
+            # Shuffle molecules inside the bucket
+            if self.shuffle:
+                bucket = bucket[torch.randperm(bucket.shape[0], generator=generator)]
+
+            # Fill batches greedily until a budget would be exceeded
+            batch = []
+            batch_num_nodes = 0
+            batch_num_edges = 0
+            for idx, num_nodes, num_edges in zip(bucket.tolist(), self.num_nodes[bucket].tolist(), self.num_edges[bucket].tolist()):
+                if batch and (
+                    (self.max_num_nodes is not None and batch_num_nodes + num_nodes > self.max_num_nodes)
+                    or (self.max_num_edges is not None and batch_num_edges + num_edges > self.max_num_edges)
+                    or (self.max_batch_size is not None and len(batch) == self.max_batch_size)
+                ):
+                    batches.append(batch)
+                    batch = []
+                    batch_num_nodes = 0
+                    batch_num_edges = 0
+                batch.append(idx)
+                batch_num_nodes += num_nodes
+                batch_num_edges += num_edges
+            if batch and not self.drop_last:
+                batches.append(batch)
+
+        # Shuffle batches across buckets
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        return batches
+
+    def __iter__(self) -> Iterator[list[int]]:
+        yield from self.batches()
+
+    def __len__(self) -> int:
+        return len(self.batches())
+
+
+class QM9DistributedSampler(Sampler[int]):
+    def __init__(
+        self,
+        dataset: QM9Dataset,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        if num_replicas is None or rank is None:
+            if not dist.is_available() or not dist.is_initialized():
+                raise ValueError("num_replicas and rank are required without an initialized process group")
+            num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+            rank = dist.get_rank() if rank is None else rank
+        if rank < 0 or rank >= num_replicas:
+            raise ValueError(f"Invalid rank {rank} for {num_replicas} replicas")
+
+        self.dataset = dataset
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+        # Give every rank a contiguous range of molecules so it only opens the shards overlapping it
+        self.start = rank * len(dataset) // num_replicas
+        self.end = (rank + 1) * len(dataset) // num_replicas
+        if drop_last:
+            self.num_samples = len(dataset) // num_replicas
+        else:
+            self.num_samples = math.ceil(len(dataset) / num_replicas)
+
+    @property
+    def shard_indices(self) -> list[int]:
+        if self.end <= self.start:
+            return []
+        first_shard_idx = bisect.bisect_right(self.dataset.shard_offsets, self.start) - 1
+        last_shard_idx = bisect.bisect_right(self.dataset.shard_offsets, self.end - 1) - 1
+        return list(range(first_shard_idx, last_shard_idx + 1))
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[int]:
+        indices = torch.arange(self.start, self.end)
+        if self.shuffle:
+            generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            indices = indices[torch.randperm(indices.shape[0], generator=generator)]
+
+        # Pad with the rank's own molecules or truncate so every rank yields the same number of samples
+        if 0 < indices.shape[0] < self.num_samples:
+            indices = torch.cat([indices, indices[:self.num_samples - indices.shape[0]]])
+        # Ranks left without molecules when there are more ranks than molecules borrow them from the whole dataset
+        elif indices.shape[0] == 0 and self.num_samples > 0:
+            indices = (torch.arange(self.num_samples) + self.rank * self.num_samples) % len(self.dataset)
+        yield from indices[:self.num_samples].tolist()
+
+    def __len__(self) -> int:
+        return self.num_samples
@@ -1,9 +1,41 @@
-import itertools
-from typing import Optional
+import functools
+import hashlib
+import re
+from pathlib import Path
+from typing import Callable, Iterable, Optional
 
+import numpy as np
 import torch
 from torch import Tensor
 
+PACKED_DATA_VERSION = 7
+
+ELEMENTS = ("H", "C", "N", "O", "F")
+ELEMENT_INDICES = {element: index for index, element in enumerate(ELEMENTS)}
+ONEHOT_TABLE = torch.eye(len(ELEMENTS), dtype=torch.float32)
+
+MAX_NUM_NODES = 29
+
+# Compact storage dtypes of packed data, widened by collate_data_dicts or widen_data_dict
+ELEMENT_DTYPE = torch.uint8
+EDGE_DTYPE = torch.int16
+SEGMENT_DTYPE = torch.int16
+OFFSET_DTYPE = torch.int32
+INDEX_DTYPE = torch.int32
+ELEMENT_COUNT_DTYPE = torch.uint8
+ELEMENT_MASK_DTYPE = torch.uint8
+
+FORMULA_PATTERN = re.compile(r"([A-Z][a-z]?)(\d*)")
+
+# Molecules without a gdb header or identifier lines
+MISSING_GDB_ID = -1
+MISSING_KEY_HASH = 0
+KEY_NAMES = ("gdb_ids", "smiles_hashes", "inchi_hashes")
+
+XYZ_ATOM_FORMAT = "%s %8.3f %8.3f %8.3f\n"
+
+PROPERTY_NAMES = ("A", "B", "C", "mu", "alpha", "homo", "lumo", "gap", "r2", "zpve", "U0", "U", "H", "G", "Cv")
+
 
 def onehot_from_element(element: str) -> Tensor:
     match element:
@@ -38,51 +70,160 @@ def element_from_onehot(onehot: Tensor) -> str:
         return "F"
 
 
-def data_dict_from_xyz_str(xyz_str: str) -> dict[str, Optional[Tensor] | list[int]]:
+def arrays_from_xyz_str(xyz_str: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
     # Read xyz file
     lines = xyz_str.splitlines()
 
     # Parse number of atoms
     num_nodes = int(lines[0])
-
-    # Parse elements and coordinates
-    elements = []
-    coordinates = []
-    for line in lines[2:num_nodes + 2]:
-        # Tokenize line
-        tokens = line.strip().split()
-        # Parse element
-        element = tokens[0].strip()
-        element = onehot_from_element(element)
-        # Parse coordinates
-        x = float(tokens[1].replace('*^', 'e'))
-        y = float(tokens[2].replace('*^', 'e'))
-        z = float(tokens[3].replace('*^', 'e'))
-        coordinate = torch.tensor([[x, y, z]])
-        # Save element and coordinates
-        elements.append(element)
-        coordinates.append(coordinate)
-
-    # Calculate edges
-    if num_nodes > 1:
-        # Generate all possible pairs of nodes
-        edges = list(itertools.combinations(range(num_nodes), 2))
-        # Separate the pairs into source and destination lists
-        src, dst = zip(*edges)
-        # Create a tensor of shape (2, x) where x is the number of edges
-        edge_index = torch.tensor([src + dst, dst + src])
+    atom_lines = lines[2:num_nodes + 2]
+    if num_nodes < 1 or len(atom_lines) != num_nodes:
+        raise ValueError(f"Invalid number of atoms {num_nodes}")
+
+    # Tokenize the atom block in one pass, converting the *^ exponent notation at once
+    rows = [line.split() for line in "\n".join(atom_lines).replace("*^", "e").split("\n")]
+
+    # Parse elements with a single lookup table
+    try:
+        elements = np.array([ELEMENT_INDICES[row[0]] for row in rows], dtype=np.int64)
+    except KeyError as e:
+        raise ValueError(f"Unknown element {e.args[0]}") from None
+
+    # Parse coordinates with a single array conversion
+    coordinates = np.array([row[1:4] for row in rows], dtype=np.float64)
+    if coordinates.shape != (num_nodes, 3):
+        raise ValueError("Invalid coordinates")
+
+    # Parse graph properties from a "gdb N A B C mu alpha ..." comment line
+    tokens = lines[1].replace("*^", "e").split()
+    if tokens and tokens[0] == "gdb":
+        properties = np.array(tokens[2:], dtype=np.float64)
+        if properties.shape != (len(PROPERTY_NAMES),):
+            raise ValueError("Invalid properties")
     else:
-        edge_index = None
+        # Molecules without properties get a NaN row, the same one the packed cache stores for them
+        properties = np.full(len(PROPERTY_NAMES), np.nan, dtype=np.float64)
+
+    return elements, coordinates, properties
+
+
+def keys_from_xyz_str(xyz_str: str) -> tuple[int, str, str]:
+    # Read the gdb id of the comment line and the GDB-17 SMILES and Corina InChI following the frequencies
+    lines = xyz_str.splitlines()
+    num_nodes = int(lines[0])
+    tokens = lines[1].split() if len(lines) > 1 else []
+    gdb_id = int(tokens[1]) if len(tokens) > 1 and tokens[0] == "gdb" else MISSING_GDB_ID
+    smiles_tokens = lines[num_nodes + 3].split() if len(lines) > num_nodes + 3 else []
+    inchi_tokens = lines[num_nodes + 4].split() if len(lines) > num_nodes + 4 else []
+    return gdb_id, smiles_tokens[0] if smiles_tokens else "", inchi_tokens[0] if inchi_tokens else ""
+
+
+def key_hashes_from_strs(strs: Iterable[str]) -> Tensor:
+    # Hash identifiers to 64 bits, reserving MISSING_KEY_HASH for empty ones
+    key_hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little", signed=True) or 1 if s else MISSING_KEY_HASH for s in strs]
+    return torch.tensor(key_hashes, dtype=torch.int64)
+
+
+def hash_table_from_key_hashes(key_hashes: Tensor, load_factor: float = 0.5) -> Tensor:
+    # Open addressing table of molecule indices, -1 for empty slots, sized to a power of two above the load factor
+    num_slots = 1 << max(int(key_hashes.shape[0] / load_factor), 1).bit_length()
+    table = torch.full((num_slots,), -1, dtype=torch.int64)
+
+    # Insert every key at once with linear probing, letting the lowest index claim a contested slot so duplicates probe in order
+    indices = torch.nonzero(key_hashes != MISSING_KEY_HASH).flatten()
+    slots = key_hashes[indices] & (num_slots - 1)
+    while indices.shape[0] > 0:
+        free = table[slots] < 0
+        claims = torch.full((num_slots,), key_hashes.shape[0], dtype=torch.int64).scatter_reduce_(0, slots[free], indices[free], reduce="amin")
+        placed = free & (claims[slots] == indices)
+        table[slots[placed]] = indices[placed]
+        indices = indices[~placed]
+        slots = (slots[~placed] + 1) & (num_slots - 1)
+
+    return table.to(INDEX_DTYPE)
+
+
+def indices_from_hash_table(table: Tensor, key_hashes: Tensor, query_hashes: Tensor) -> Tensor:
+    # Probe every query at once until it hits its key or an empty slot, returning the first matching index or -1
+    num_slots = table.shape[0]
+    indices = torch.full(query_hashes.shape, -1, dtype=torch.int64)
+    queries = torch.nonzero(query_hashes != MISSING_KEY_HASH).flatten()
+    slots = query_hashes[queries] & (num_slots - 1)
+    while queries.shape[0] > 0:
+        candidates = table[slots].to(torch.int64)
+        empty = candidates < 0
+        found = ~empty & (key_hashes[candidates.clamp(min=0)] == query_hashes[queries])
+        indices[queries[found]] = candidates[found]
+        pending = ~empty & ~found
+        queries = queries[pending]
+        slots = (slots[pending] + 1) & (num_slots - 1)
+    return indices
+
+
+def gdb_table_from_gdb_ids(gdb_ids: Tensor) -> Tensor:
+    # Direct address table from gdb id to the lowest molecule index carrying it, -1 for unused ids
+    gdb_ids = gdb_ids.to(torch.int64)
+    valid = gdb_ids != MISSING_GDB_ID
+    num_ids = int(gdb_ids[valid].max()) + 1 if valid.any() else 0
+    table = torch.full((num_ids,), gdb_ids.shape[0], dtype=torch.int64)
+    table.scatter_reduce_(0, gdb_ids[valid], torch.nonzero(valid).flatten(), reduce="amin")
+    table[table == gdb_ids.shape[0]] = -1
+    return table.to(INDEX_DTYPE)
+
+
+@functools.lru_cache(maxsize=None)
+def edge_index_from_num_nodes(num_nodes: int) -> Optional[Tensor]:
+    if num_nodes < 2:
+        return None
+    # Generate all possible pairs of nodes in the same order as itertools.combinations
+    src, dst = torch.triu_indices(num_nodes, num_nodes, offset=1)
+    # Create a tensor of shape (2, x) where x is the number of edges
+    return torch.stack([torch.cat([src, dst]), torch.cat([dst, src])])
+
+
+def radius_edge_index_from_positions(x: Tensor, e: Tensor, cutoff: float, max_num_neighbors: Optional[int] = None) -> Tensor:
+    # Keep the candidate edges whose endpoints lie within the cutoff, using one vectorized distance computation
+    distances = torch.linalg.vector_norm(x[e[0]] - x[e[1]], dim=1)
+    within_cutoff = distances <= cutoff
+    e = e[:, within_cutoff]
+    distances = distances[within_cutoff]
+
+    # Keep only the nearest neighbors of every source node, preserving the candidate order
+    if max_num_neighbors is not None and e.shape[1] > 0:
+        order = torch.argsort(distances, stable=True)
+        order = order[torch.argsort(e[0, order], stable=True)]
+        counts = torch.bincount(e[0], minlength=x.shape[0])
+        ranks = torch.arange(order.shape[0]) - (torch.cumsum(counts, dim=0) - counts)[e[0, order]]
+        keep = torch.zeros(e.shape[1], dtype=torch.bool)
+        keep[order[ranks < max_num_neighbors]] = True
+        e = e[:, keep]
+
+    return e
+
+
+def data_dict_from_xyz_str(xyz_str: str, cutoff: Optional[float] = None, max_num_neighbors: Optional[int] = None) -> dict[str, Optional[Tensor] | list[int]]:
+    # Parse elements, coordinates and properties
+    elements, coordinates, properties = arrays_from_xyz_str(xyz_str)
+    num_nodes = elements.shape[0]
+    x = torch.from_numpy(coordinates.astype(np.float32))
+
+    # Calculate edges, copying the cached template so callers may modify it
+    edge_index = edge_index_from_num_nodes(num_nodes)
+    if edge_index is not None:
+        if cutoff is None:
+            edge_index = edge_index.clone()
+        else:
+            edge_index = radius_edge_index_from_positions(x, edge_index, cutoff, max_num_neighbors)
 
     # Calculate segments
     segments = torch.tensor([num_nodes])
 
     data_dict = {
-        "h": torch.vstack(elements),
-        "x": torch.vstack(coordinates),
+        "h": ONEHOT_TABLE[torch.from_numpy(elements)],
+        "x": x,
         "e": edge_index,
         "a": None,
-        "g": None,
+        "g": torch.from_numpy(properties)[None],
         "h_ctx": None,
         "x_ctx": None,
         "e_ctx": None,
@@ -94,37 +235,438 @@ def data_dict_from_xyz_str(xyz_str: str) -> dict[str, Optional[Tensor] | list[in
     return data_dict
 
 
-def xyz_str_from_data_dict(data_dict: dict[str, Optional[Tensor] | list[int]]) -> str:
-    xyz_str = ""
+def packed_data_from_xyz_strs(xyz_strs: list[str], on_error: Optional[Callable[[int, Exception], None]] = None, store_edges: bool = True, cutoff: Optional[float] = None, max_num_neighbors: Optional[int] = None) -> dict[str, int | Tensor]:
+    # Parse every molecule, reporting invalid ones to on_error instead of raising if given
+    elements = []
+    coordinates = []
+    properties = []
+    keys = []
+    for index, xyz_str in enumerate(xyz_strs):
+        try:
+            molecule_elements, molecule_coordinates, molecule_properties = arrays_from_xyz_str(xyz_str)
+            molecule_keys = keys_from_xyz_str(xyz_str)
+        except Exception as e:
+            if on_error is None:
+                raise
+            on_error(index, e)
+            continue
+        elements.append(molecule_elements)
+        coordinates.append(molecule_coordinates)
+        properties.append(molecule_properties)
+        keys.append(molecule_keys)
+
+    # Calculate segments and offsets
+    segments = torch.tensor([molecule_elements.shape[0] for molecule_elements in elements], dtype=torch.int64)
+    node_offsets = torch.zeros(len(elements) + 1, dtype=torch.int64)
+    node_offsets[1:] = torch.cumsum(segments, dim=0)
+
+    # Build nodes features and positions of all molecules at once
+    if elements:
+        h = torch.from_numpy(np.concatenate(elements))
+        x = torch.from_numpy(np.concatenate(coordinates).astype(np.float32))
+    else:
+        h = torch.zeros((0,), dtype=torch.int64)
+        x = torch.zeros((0, 3), dtype=torch.float32)
+
+    packed_data = {
+        "version": PACKED_DATA_VERSION,
+        "h": h,
+        "x": x,
+        "segments": segments,
+        "node_offsets": node_offsets,
+    }
 
-    n = data_dict["segments"].item()
+    # Keep identifiers as ids and hashes so the key index can be built without the strings
+    gdb_ids, smiles, inchi = zip(*keys) if keys else ((), (), ())
+    packed_data["gdb_ids"] = torch.tensor(gdb_ids, dtype=torch.int64)
+    packed_data["smiles_hashes"] = key_hashes_from_strs(smiles)
+    packed_data["inchi_hashes"] = key_hashes_from_strs(inchi)
+
+    # Stack graph properties into a columnar table, NaN rows marking molecules without them
+    packed_data["g"] = torch.from_numpy(np.stack(properties) if properties else np.zeros((0, len(PROPERTY_NAMES)), dtype=np.float64))
+
+    # Concatenate edge templates, unless they are generated on demand
+    if store_edges:
+        edges = [edge_index_from_num_nodes(num_nodes) for num_nodes in segments.tolist() if num_nodes > 1]
+        packed_data["e"] = torch.cat(edges, dim=1) if edges else torch.zeros((2, 0), dtype=torch.int64)
+        packed_data["edge_offsets"] = torch.zeros(len(elements) + 1, dtype=torch.int64)
+        packed_data["edge_offsets"][1:] = torch.cumsum(segments * (segments - 1), dim=0)
+
+        # Filter the edges of every molecule by distance at once, shifting them to global node indices and back
+        if cutoff is not None:
+            num_edges = segments * (segments - 1)
+            edge_shifts = torch.repeat_interleave(node_offsets[:-1], num_edges)
+            e = radius_edge_index_from_positions(x, packed_data["e"] + edge_shifts, cutoff, max_num_neighbors)
+            molecule_indices = torch.repeat_interleave(torch.arange(len(elements)), segments)[e[0]]
+            packed_data["e"] = e - node_offsets[molecule_indices]
+            packed_data["edge_offsets"][1:] = torch.cumsum(torch.bincount(molecule_indices, minlength=len(elements)), dim=0)
+
+    return narrow_packed_data(packed_data)
+
+
+def narrow_packed_data(packed_data: dict[str, int | Tensor]) -> dict[str, int | Tensor]:
+    # Store element indices instead of one-hot rows and the smallest integer types that fit QM9
+    h = packed_data["h"]
+    narrowed_packed_data = dict(packed_data)
+    narrowed_packed_data["h"] = (h.argmax(dim=1) if h.dim() == 2 else h).to(ELEMENT_DTYPE)
+    narrowed_packed_data["segments"] = packed_data["segments"].to(SEGMENT_DTYPE)
+    narrowed_packed_data["node_offsets"] = packed_data["node_offsets"].to(OFFSET_DTYPE)
+    if "gdb_ids" in packed_data:
+        narrowed_packed_data["gdb_ids"] = packed_data["gdb_ids"].to(INDEX_DTYPE)
+    if "e" in packed_data:
+        narrowed_packed_data["e"] = packed_data["e"].to(EDGE_DTYPE)
+        narrowed_packed_data["edge_offsets"] = packed_data["edge_offsets"].to(OFFSET_DTYPE)
+    return narrowed_packed_data
+
+
+def widen_data_dict(data_dict: dict[str, Optional[Tensor] | list[int]], dtype: torch.dtype = torch.float32) -> dict[str, Optional[Tensor] | list[int]]:
+    # Expand compact element indices into one-hot rows and integers back to int64
     h = data_dict["h"]
-    x = data_dict["x"]
+    return {
+        **data_dict,
+        "h": ONEHOT_TABLE.to(dtype)[h.long()] if h.dim() == 1 else h.to(dtype),
+        "x": data_dict["x"].to(dtype),
+        "e": None if data_dict["e"] is None else data_dict["e"].to(torch.int64),
+        "segments": data_dict["segments"].to(torch.int64),
+    }
 
-    assert h.shape[0] == x.shape[0], "Number of nodes does not match number of coordinates"
 
-    xyz_str += f"{n}\n\n"
+def xyz_str_from_data_dict(data_dict: dict[str, Optional[Tensor] | list[int]]) -> str:
+    assert data_dict["h"].shape[0] == data_dict["x"].shape[0], "Number of nodes does not match number of coordinates"
+
+    return xyz_strs_from_data_dict(data_dict)[0]
+
+
+def xyz_strs_from_data_dict(data_dict: dict[str, Optional[Tensor] | list[int]], comments: Optional[list[str]] = None) -> list[str]:
+    h = data_dict["h"].detach().cpu()
+    x = data_dict["x"].detach().cpu()
+    segments = data_dict["segments"].tolist()
+
+    if h.shape[0] != x.shape[0]:
+        raise ValueError("Number of nodes does not match number of coordinates")
+
+    # Decode every element with a single argmax and lookup
+    atoms = np.empty((h.shape[0], 4), dtype=object)
+    atoms[:, 0] = np.array(ELEMENTS)[(h.argmax(dim=1) if h.dim() == 2 else h.long()).numpy()]
+    atoms[:, 1:] = x.numpy()
+    # Flatten into the arguments of one format call per molecule
+    values = atoms.ravel().tolist()
+
+    xyz_strs = []
+    node_start = 0
+    for i, num_nodes in enumerate(segments):
+        comment = "" if comments is None else comments[i]
+        xyz_strs.append(f"{num_nodes}\n{comment}\n" + (XYZ_ATOM_FORMAT * num_nodes) % tuple(values[4 * node_start:4 * (node_start + num_nodes)]))
+        node_start += num_nodes
+
+    return xyz_strs
+
+
+def write_xyz(data_dicts: dict[str, Optional[Tensor] | list[int]] | Iterable[dict[str, Optional[Tensor] | list[int]]], path: str | Path, member_name_format: str = "molecule_{:06d}.xyz") -> int:
+    # Accept a single collated batch or packed slice as well as a stream of them
+    if isinstance(data_dicts, dict):
+        data_dicts = [data_dicts]
+
+    path = Path(path)
+    num_molecules = 0
+    if path.name.endswith((".tar", ".tar.gz", ".tar.bz2", ".tar.xz")):
+        import io
+        import tarfile
+
+        # Write one archive member per molecule
+        mode = "w" if path.suffix == ".tar" else f"w:{path.suffix[1:]}"
+        with tarfile.open(path, mode) as tar:
+            for data_dict in data_dicts:
+                for xyz_str in xyz_strs_from_data_dict(data_dict):
+                    data = xyz_str.encode("utf-8")
+                    member = tarfile.TarInfo(member_name_format.format(num_molecules))
+                    member.size = len(data)
+                    tar.addfile(member, io.BytesIO(data))
+                    num_molecules += 1
+    else:
+        # Write every molecule into one multi-frame .xyz file
+        with open(path, "w") as file:
+            for data_dict in data_dicts:
+                xyz_strs = xyz_strs_from_data_dict(data_dict)
+                file.write("".join(xyz_strs))
+                num_molecules += len(xyz_strs)
+
+    return num_molecules
+
+
+def packed_data_from_data_dicts(data_dicts: list[dict[str, Optional[Tensor] | list[int]]]) -> dict[str, int | Tensor]:
+    # Count nodes and edges per molecule
+    segments = torch.tensor([data_dict["h"].shape[0] for data_dict in data_dicts], dtype=torch.int64)
+    num_edges = torch.tensor([0 if data_dict["e"] is None else data_dict["e"].shape[1] for data_dict in data_dicts], dtype=torch.int64)
+
+    # Calculate offsets into the packed arrays
+    node_offsets = torch.zeros(len(data_dicts) + 1, dtype=torch.int64)
+    node_offsets[1:] = torch.cumsum(segments, dim=0)
+    edge_offsets = torch.zeros(len(data_dicts) + 1, dtype=torch.int64)
+    edge_offsets[1:] = torch.cumsum(num_edges, dim=0)
+
+    # Concatenate nodes features, positions and edges
+    h = torch.cat([data_dict["h"] for data_dict in data_dicts], dim=0) if data_dicts else torch.zeros((0,), dtype=torch.int64)
+    x = torch.cat([data_dict["x"] for data_dict in data_dicts], dim=0) if data_dicts else torch.zeros((0, 3), dtype=torch.float32)
+    edges = [data_dict["e"] for data_dict in data_dicts if data_dict["e"] is not None]
+    e = torch.cat(edges, dim=1) if edges else torch.zeros((2, 0), dtype=torch.int64)
+
+    packed_data = {
+        "version": PACKED_DATA_VERSION,
+        "h": h,
+        "x": x,
+        "e": e,
+        "segments": segments,
+        "node_offsets": node_offsets,
+        "edge_offsets": edge_offsets,
+    }
 
-    for onehot, coordinate in zip(h, x):
-        element = element_from_onehot(onehot)
-        xyz_str += f"{element} {coordinate[0]:8.3f} {coordinate[1]:8.3f} {coordinate[2]:8.3f}\n"
+    # Concatenate graph properties
+    if data_dicts and all(data_dict["g"] is not None for data_dict in data_dicts):
+        packed_data["g"] = torch.cat([data_dict["g"] for data_dict in data_dicts], dim=0)
+
+    return narrow_packed_data(packed_data)
+
+
+def concat_packed_data(packed_datas: list[dict[str, int | Tensor]]) -> dict[str, int | Tensor]:
+    # Shift offsets of every chunk by the number of nodes and edges before it
+    store_edges = "e" in packed_datas[0]
+    node_offsets = [torch.zeros(1, dtype=OFFSET_DTYPE)]
+    edge_offsets = [torch.zeros(1, dtype=OFFSET_DTYPE)]
+    num_nodes = 0
+    num_edges = 0
+    for packed_data in packed_datas:
+        node_offsets.append(packed_data["node_offsets"][1:] + num_nodes)
+        num_nodes += packed_data["h"].shape[0]
+        if store_edges:
+            edge_offsets.append(packed_data["edge_offsets"][1:] + num_edges)
+            num_edges += packed_data["e"].shape[1]
+
+    packed_data = {
+        "version": PACKED_DATA_VERSION,
+        "h": torch.cat([packed_data["h"] for packed_data in packed_datas], dim=0),
+        "x": torch.cat([packed_data["x"] for packed_data in packed_datas], dim=0),
+        "segments": torch.cat([packed_data["segments"] for packed_data in packed_datas]),
+        "node_offsets": torch.cat(node_offsets),
+    }
+    if store_edges:
+        packed_data["e"] = torch.cat([packed_data["e"] for packed_data in packed_datas], dim=1)
+        packed_data["edge_offsets"] = torch.cat(edge_offsets)
+    for key in KEY_NAMES:
+        if key in packed_datas[0]:
+            packed_data[key] = torch.cat([packed_data[key] for packed_data in packed_datas])
+    if any("g" in packed_data for packed_data in packed_datas):
+        packed_data["g"] = torch.cat([
+            packed_data["g"] if "g" in packed_data else torch.full((packed_data["segments"].shape[0], len(PROPERTY_NAMES)), torch.nan, dtype=torch.float64)
+            for packed_data in packed_datas
+        ], dim=0)
+
+    return packed_data
+
+
+def slice_packed_data(packed_data: dict[str, int | Tensor], start: int, end: int) -> dict[str, int | Tensor]:
+    # Slice molecules [start, end) and rebase their offsets to zero
+    node_start, node_end = packed_data["node_offsets"][[start, end]].tolist()
+    sliced_packed_data = {
+        "version": PACKED_DATA_VERSION,
+        "h": packed_data["h"][node_start:node_end],
+        "x": packed_data["x"][node_start:node_end],
+        "segments": packed_data["segments"][start:end],
+        "node_offsets": packed_data["node_offsets"][start:end + 1] - node_start,
+    }
+    if "e" in packed_data:
+        edge_start, edge_end = packed_data["edge_offsets"][[start, end]].tolist()
+        sliced_packed_data["e"] = packed_data["e"][:, edge_start:edge_end]
+        sliced_packed_data["edge_offsets"] = packed_data["edge_offsets"][start:end + 1] - edge_start
+    for key in ("g", *KEY_NAMES):
+        if key in packed_data:
+            sliced_packed_data[key] = packed_data[key][start:end]
+    return sliced_packed_data
+
+
+def property_stats_from_properties(g: Tensor) -> dict[str, Tensor]:
+    # Ignore molecules without properties
+    g = g[~torch.isnan(g).any(dim=1)]
+    return {
+        "mean": g.mean(dim=0),
+        "std": g.std(dim=0),
+        "min": g.min(dim=0).values,
+        "max": g.max(dim=0).values,
+    }
 
-    return xyz_str
 
+def element_counts_from_packed_data(packed_data: dict[str, int | Tensor]) -> Tensor:
+    # Count the atoms of every element in every molecule with a single bincount over molecule and element pairs
+    segments = packed_data["segments"].to(torch.int64)
+    molecule_indices = torch.repeat_interleave(torch.arange(segments.shape[0]), segments)
+    counts = torch.bincount(molecule_indices * len(ELEMENTS) + packed_data["h"].to(torch.int64), minlength=segments.shape[0] * len(ELEMENTS))
+    return counts.view(segments.shape[0], len(ELEMENTS)).to(ELEMENT_COUNT_DTYPE)
+
+
+def element_masks_from_element_counts(element_counts: Tensor) -> Tensor:
+    # Bitmap of the elements present in every molecule, bit i standing for ELEMENTS[i]
+    bits = torch.tensor([1 << i for i in range(len(ELEMENTS))], dtype=torch.int64)
+    return ((element_counts > 0).to(torch.int64) * bits).sum(dim=1).to(ELEMENT_MASK_DTYPE)
+
+
+def element_mask_from_elements(elements: Iterable[str]) -> int:
+    try:
+        return sum(1 << ELEMENT_INDICES[element] for element in set(elements))
+    except KeyError as e:
+        raise ValueError(f"Unknown element {e.args[0]}") from None
+
+
+def element_counts_from_formula(formula: str) -> Tensor:
+    # Parse a Hill formula such as C7H10O2, leaving elements it does not mention at zero
+    counts = torch.zeros(len(ELEMENTS), dtype=torch.int64)
+    matches = list(FORMULA_PATTERN.finditer(formula))
+    if not formula or "".join(match.group(0) for match in matches) != formula:
+        raise ValueError(f"Invalid formula {formula}")
+    for match in matches:
+        if match.group(1) not in ELEMENT_INDICES:
+            raise ValueError(f"Unknown element {match.group(1)}")
+        counts[ELEMENT_INDICES[match.group(1)]] += int(match.group(2) or 1)
+    return counts
+
+
+def composition_columns(element_counts: Tensor) -> dict[str, Tensor]:
+    # Expose the composition table as named columns, one per element plus atom and heavy atom counts
+    element_counts = element_counts.to(torch.int64)
+    columns = {element: element_counts[:, i] for i, element in enumerate(ELEMENTS)}
+    columns["num_nodes"] = element_counts.sum(dim=1)
+    columns["num_heavy_atoms"] = columns["num_nodes"] - columns["H"]
+    return columns
+
+
+def composition_mask(
+    element_counts: Tensor,
+    element_masks: Tensor,
+    predicate: Optional[Callable[[dict[str, Tensor]], Tensor]] = None,
+    formula: Optional[str] = None,
+    include_elements: Optional[Iterable[str]] = None,
+    exclude_elements: Optional[Iterable[str]] = None,
+    min_num_heavy_atoms: Optional[int] = None,
+    max_num_heavy_atoms: Optional[int] = None,
+) -> Tensor:
+    # Combine every filter into one boolean mask over molecules, testing element presence on the bitmaps
+    mask = torch.ones(element_counts.shape[0], dtype=torch.bool)
+    if include_elements is not None:
+        include_mask = element_mask_from_elements(include_elements)
+        mask &= (element_masks.to(torch.int64) & include_mask) == include_mask
+    if exclude_elements is not None:
+        mask &= (element_masks.to(torch.int64) & element_mask_from_elements(exclude_elements)) == 0
+    if formula is not None:
+        mask &= (element_counts.to(torch.int64) == element_counts_from_formula(formula)).all(dim=1)
+    if min_num_heavy_atoms is not None or max_num_heavy_atoms is not None or predicate is not None:
+        columns = composition_columns(element_counts)
+        if min_num_heavy_atoms is not None:
+            mask &= columns["num_heavy_atoms"] >= min_num_heavy_atoms
+        if max_num_heavy_atoms is not None:
+            mask &= columns["num_heavy_atoms"] <= max_num_heavy_atoms
+        if predicate is not None:
+            mask &= predicate(columns)
+    return mask
+
+
+def center_positions(x: Tensor, segments: Tensor) -> Tensor:
+    # Subtract the mean position of every molecule, summing all molecules in a single index_add pass
+    segments = segments.to(torch.int64)
+    molecule_indices = torch.repeat_interleave(torch.arange(segments.shape[0]), segments)
+    sums = torch.zeros((segments.shape[0], x.shape[1]), dtype=torch.float64).index_add_(0, molecule_indices, x.to(torch.float64))
+    means = sums / segments.clamp(min=1)[:, None]
+    return (x.to(torch.float64) - means[molecule_indices]).to(x.dtype)
+
+
+def random_rotation_matrices(num_rotations: int, generator: Optional[torch.Generator] = None) -> Tensor:
+    # Sample uniform rotations from normalized random quaternions
+    w, i, j, k = torch.nn.functional.normalize(torch.randn((num_rotations, 4), generator=generator, dtype=torch.float64), dim=1).unbind(dim=1)
+    return torch.stack([
+        torch.stack([1 - 2 * (j * j + k * k), 2 * (i * j - k * w), 2 * (i * k + j * w)], dim=1),
+        torch.stack([2 * (i * j + k * w), 1 - 2 * (i * i + k * k), 2 * (j * k - i * w)], dim=1),
+        torch.stack([2 * (i * k - j * w), 2 * (j * k + i * w), 1 - 2 * (i * i + j * j)], dim=1),
+    ], dim=1)
+
+
+def rotate_data_dict(data_dict: dict[str, Optional[Tensor] | list[int]], generator: Optional[torch.Generator] = None) -> dict[str, Optional[Tensor] | list[int]]:
+    # Rotate every molecule of a collated batch about the origin by its own random rotation
+    # Sample on the generator's device so seeded rotations do not depend on where the batch lives, then move them to it
+    segments = data_dict["segments"]
+    device = data_dict["x"].device
+    rotations = random_rotation_matrices(segments.shape[0], generator=generator).to(device=device, dtype=data_dict["x"].dtype)
+    molecule_indices = torch.repeat_interleave(torch.arange(segments.shape[0], device=device), segments.to(device))
+
+    # Apply all rotations with a single batched matmul
+    x = torch.bmm(rotations[molecule_indices], data_dict["x"][:, :, None])[:, :, 0]
+    return {**data_dict, "x": x}
+
+
+def data_dict_from_packed_data(packed_data: dict[str, int | Tensor], idx: int, widen: bool = True) -> dict[str, Optional[Tensor] | list[int]]:
+    # Normalize index
+    num_molecules = packed_data["segments"].shape[0]
+    if idx < 0:
+        idx += num_molecules
+    if idx < 0 or idx >= num_molecules:
+        raise IndexError(f"Index {idx} out of range for {num_molecules} molecules")
+
+    # Slice views out of the packed arrays
+    node_start, node_end = packed_data["node_offsets"][idx:idx + 2].tolist()
+    if "e" in packed_data:
+        edge_start, edge_end = packed_data["edge_offsets"][idx:idx + 2].tolist()
+        # Molecules may keep no edges under a cutoff, which is different from having a single atom
+        e = packed_data["e"][:, edge_start:edge_end] if node_end - node_start > 1 else None
+    else:
+        # Edges are not stored, copy the cached fully connected template so callers may modify it
+        e = edge_index_from_num_nodes(node_end - node_start)
+        if e is not None:
+            e = e.clone()
 
-def collate_data_dicts(data_dicts: list[dict[str, Optional[Tensor] | list[int]]]) -> dict[str, Optional[Tensor] | list[int]]:
+    data_dict = {
+        "h": packed_data["h"][node_start:node_end],
+        "x": packed_data["x"][node_start:node_end],
+        "e": e,
+        "a": None,
+        "g": packed_data["g"][idx:idx + 1] if "g" in packed_data else None,
+        "h_ctx": None,
+        "x_ctx": None,
+        "e_ctx": None,
+        "a_ctx": None,
+        "g_ctx": None,
+        "segments": packed_data["segments"][idx:idx + 1],
+    }
+
+    # Leave compact views for collate_data_dicts to widen a whole batch at once
+    return widen_data_dict(data_dict) if widen else data_dict
+
+
+def collate_data_dicts(data_dicts: list[dict[str, Optional[Tensor] | list[int]]], cutoff: Optional[float] = None, max_num_neighbors: Optional[int] = None, dtype: Optional[torch.dtype] = None) -> dict[str, Optional[Tensor] | list[int]]:
     # Concatenate segments
-    segments = torch.cat([data_dict["segments"] for data_dict in data_dicts])
+    segments = torch.cat([data_dict["segments"] for data_dict in data_dicts]).to(torch.int64)
+
+    # Calculate node offsets of every molecule at once
+    offsets = torch.cumsum(segments, dim=0) - segments
 
-    # Concatenate nodes features
+    # Concatenate nodes features, expanding compact element indices into one-hot rows in one lookup
     h = torch.cat([data_dict["h"] for data_dict in data_dicts], dim=0)
+    if h.dim() == 1:
+        h = ONEHOT_TABLE.to(dtype or torch.float32)[h.long()]
+    elif dtype is not None:
+        h = h.to(dtype)
 
     # Concatenate positions
     x = torch.cat([data_dict["x"] for data_dict in data_dicts], dim=0)
+    if dtype is not None:
+        x = x.to(dtype)
 
-    # Concatenate edges
-    offsets = [0] + segments.tolist()[:-1]
-    e = torch.cat([data_dict["e"] + offset for data_dict, offset in zip(data_dicts, offsets)], dim=1)
+    # Concatenate edges, generating missing ones from the fully connected template
+    edges = [data_dict["e"] if data_dict["e"] is not None else edge_index_from_num_nodes(data_dict["h"].shape[0]) for data_dict in data_dicts]
+    num_edges = torch.tensor([0 if edge is None else edge.shape[1] for edge in edges], dtype=torch.int64)
+    e = torch.cat([edge for edge in edges if edge is not None] or [torch.zeros((2, 0), dtype=torch.int64)], dim=1).to(torch.int64)
+    # Shift every edge by the offset of its molecule in one operation
+    e += torch.repeat_interleave(offsets, num_edges)
+
+    # Build radius graphs for the whole batch at once
+    if cutoff is not None:
+        e = radius_edge_index_from_positions(x, e, cutoff, max_num_neighbors)
 
     # Concatenate edge features
     if data_dicts[0]["a"] is not None:
@@ -152,13 +694,13 @@ def collate_data_dicts(data_dicts: list[dict[str, Optional[Tensor] | list[int]]]
 
     # Concatenate edges
     if data_dicts[0]["e_ctx"] is not None:
-        ctx_segments = [data_dict["h_ctx"].shape[0] for data_dict in data_dicts]
-        ctx_offsets = [0] + ctx_segments[:-1]
-        global_offset = sum(segments)
-        e_ctx = torch.cat([torch.cat([
-            data_dict["e_ctx"][:1] + offset,
-            data_dict["e_ctx"][1:] - data_dict["h"].shape[0] + global_offset + ctx_offset,
-        ], dim=0) for data_dict, offset, ctx_offset in zip(data_dicts, offsets, ctx_offsets)], dim=1)
+        num_ctx_nodes = torch.tensor([data_dict["h_ctx"].shape[0] for data_dict in data_dicts], dtype=torch.int64)
+        ctx_offsets = torch.cumsum(num_ctx_nodes, dim=0) - num_ctx_nodes
+        num_ctx_edges = torch.tensor([data_dict["e_ctx"].shape[1] for data_dict in data_dicts], dtype=torch.int64)
+        e_ctx = torch.cat([data_dict["e_ctx"] for data_dict in data_dicts], dim=1)
+        # Shift molecule nodes by their offsets and context nodes past the last molecule node
+        e_ctx[0] += torch.repeat_interleave(offsets, num_ctx_edges)
+        e_ctx[1] += torch.repeat_interleave(ctx_offsets - segments + segments.sum(), num_ctx_edges)
     else:
         e_ctx = None
 
@@ -187,3 +729,137 @@ def collate_data_dicts(data_dicts: list[dict[str, Optional[Tensor] | list[int]]]
         "g_ctx": g_ctx,
         "segments": segments,
     }
+
+
+def indices_from_ranges(starts: Tensor, lengths: Tensor) -> Tensor:
+    # Concatenate the ranges [start, start + length) of every molecule into one index in a single pass
+    ends = torch.cumsum(lengths, dim=0)
+    return torch.repeat_interleave(starts - (ends - lengths), lengths) + torch.arange(int(ends[-1]) if ends.shape[0] > 0 else 0)
+
+
+@functools.lru_cache(maxsize=None)
+def edge_templates_from_max_num_nodes(max_num_nodes: int) -> tuple[Tensor, Tensor]:
+    # Concatenate the fully connected templates of every size up to max_num_nodes, with their offsets indexed by size
+    num_nodes = torch.arange(max_num_nodes + 1)
+    template_offsets = torch.zeros(max_num_nodes + 2, dtype=torch.int64)
+    template_offsets[1:] = torch.cumsum(num_nodes * (num_nodes - 1), dim=0)
+    templates = [edge_index_from_num_nodes(num_nodes) for num_nodes in range(2, max_num_nodes + 1)]
+    return torch.cat(templates or [torch.zeros((2, 0), dtype=torch.int64)], dim=1), template_offsets
+
+
+def gather_packed_data(packed_data: dict[str, int | Tensor], indices: Tensor) -> dict[str, int | Tensor]:
+    # Gather molecules in any order into new packed data, keeping compact types and rebasing offsets to zero
+    indices = torch.as_tensor(indices, dtype=torch.int64)
+    node_offsets = packed_data["node_offsets"].to(torch.int64)
+    segments = node_offsets[indices + 1] - node_offsets[indices]
+    node_index = indices_from_ranges(node_offsets[indices], segments)
+    gathered_packed_data = {
+        "version": PACKED_DATA_VERSION,
+        "h": packed_data["h"][node_index],
+        "x": packed_data["x"][node_index],
+        "segments": packed_data["segments"][indices],
+        "node_offsets": torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(segments, dim=0)]).to(packed_data["node_offsets"].dtype),
+    }
+    if "e" in packed_data:
+        edge_offsets = packed_data["edge_offsets"].to(torch.int64)
+        num_edges = edge_offsets[indices + 1] - edge_offsets[indices]
+        gathered_packed_data["e"] = packed_data["e"][:, indices_from_ranges(edge_offsets[indices], num_edges)]
+        gathered_packed_data["edge_offsets"] = torch.cat([torch.zeros(1, dtype=torch.int64), torch.cumsum(num_edges, dim=0)]).to(packed_data["edge_offsets"].dtype)
+    for key in ("g", *KEY_NAMES):
+        if key in packed_data:
+            gathered_packed_data[key] = packed_data[key][indices]
+    return gathered_packed_data
+
+
+def collate_packed_data(packed_data: dict[str, int | Tensor], indices: Optional[Tensor | list[int]] = None, cutoff: Optional[float] = None, max_num_neighbors: Optional[int] = None, dtype: Optional[torch.dtype] = None) -> dict[str, Optional[Tensor] | list[int]]:
+    # Normalize indices, collating every molecule by default
+    num_molecules = packed_data["segments"].shape[0]
+    indices = torch.arange(num_molecules) if indices is None else torch.as_tensor(indices, dtype=torch.int64)
+    indices = torch.where(indices < 0, indices + num_molecules, indices)
+    if indices.shape[0] > 0 and (int(indices.min()) < 0 or int(indices.max()) >= num_molecules):
+        raise IndexError(f"Index out of range for {num_molecules} molecules")
+
+    # Calculate sizes and batch offsets of every molecule from the packed offsets at once
+    node_offsets = packed_data["node_offsets"].to(torch.int64)
+    segments = node_offsets[indices + 1] - node_offsets[indices]
+    offsets = torch.cumsum(segments, dim=0) - segments
+
+    # Gather nodes features and positions into tensors of the batch size, expanding element indices into one-hot rows in one lookup
+    node_index = indices_from_ranges(node_offsets[indices], segments)
+    h = packed_data["h"][node_index]
+    h = ONEHOT_TABLE.to(dtype or torch.float32)[h.long()] if h.dim() == 1 else h.to(dtype or torch.float32)
+    x = packed_data["x"][node_index].to(dtype or torch.float32)
+
+    # Gather stored edges, or the fully connected templates when edges are generated on demand
+    if "e" in packed_data:
+        edge_offsets = packed_data["edge_offsets"].to(torch.int64)
+        edge_starts = edge_offsets[indices]
+        num_edges = edge_offsets[indices + 1] - edge_starts
+        edges = packed_data["e"]
+    else:
+        edges, template_offsets = edge_templates_from_max_num_nodes(int(segments.max()) if segments.shape[0] > 0 else 0)
+        edge_starts = template_offsets[segments]
+        num_edges = segments * (segments - 1)
+    e = edges[:, indices_from_ranges(edge_starts, num_edges)].to(torch.int64)
+    # Shift every edge by the offset of its molecule in one operation
+    e += torch.repeat_interleave(offsets, num_edges)
+
+    # Build radius graphs for the whole batch at once
+    if cutoff is not None:
+        e = radius_edge_index_from_positions(x, e, cutoff, max_num_neighbors)
+
+    return {
+        "h": h,
+        "x": x,
+        "e": e,
+        "a": None,
+        "g": packed_data["g"][indices] if "g" in packed_data else None,
+        "h_ctx": None,
+        "x_ctx": None,
+        "e_ctx": None,
+        "a_ctx": None,
+        "g_ctx": None,
+        "segments": segments,
+    }
+
+
+def collate_data_dicts_dense(data_dicts: list[dict[str, Optional[Tensor] | list[int]]], max_num_nodes: Optional[int] = None, dtype: Optional[torch.dtype] = None) -> dict[str, Optional[Tensor]]:
+    # Collate sparsely first, then scatter into padded tensors
+    collated_data_dict = collate_data_dicts(data_dicts, dtype=dtype)
+    segments = collated_data_dict["segments"]
+    num_graphs = segments.shape[0]
+
+    # Calculate padded size
+    if max_num_nodes is None:
+        max_num_nodes = int(segments.max()) if num_graphs > 0 else 0
+    elif num_graphs > 0 and int(segments.max()) > max_num_nodes:
+        raise ValueError(f"Molecule with {int(segments.max())} atoms does not fit in {max_num_nodes} nodes")
+
+    # Calculate graph and position of every node at once
+    offsets = torch.cumsum(segments, dim=0) - segments
+    graph_index = torch.repeat_interleave(torch.arange(num_graphs), segments)
+    node_index = torch.arange(graph_index.shape[0]) - offsets[graph_index]
+
+    # Scatter nodes features and positions
+    h = collated_data_dict["h"]
+    x = collated_data_dict["x"]
+    dense_h = h.new_zeros((num_graphs, max_num_nodes, h.shape[1]))
+    dense_h[graph_index, node_index] = h
+    dense_x = x.new_zeros((num_graphs, max_num_nodes, x.shape[1]))
+    dense_x[graph_index, node_index] = x
+    node_mask = torch.zeros((num_graphs, max_num_nodes), dtype=torch.bool)
+    node_mask[graph_index, node_index] = True
+
+    # Scatter edges into a pairwise mask
+    e = collated_data_dict["e"]
+    edge_mask = torch.zeros((num_graphs, max_num_nodes, max_num_nodes), dtype=torch.bool)
+    edge_mask[graph_index[e[0]], node_index[e[0]], node_index[e[1]]] = True
+
+    return {
+        "h": dense_h,
+        "x": dense_x,
+        "g": collated_data_dict["g"],
+        "node_mask": node_mask,
+        "edge_mask": edge_mask,
+        "segments": segments,
+    }
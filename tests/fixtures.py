@@ -1,9 +1,49 @@
+import hashlib
+import io
 import itertools
+import tarfile
+from pathlib import Path
 
 import pytest
 import torch
 
 
+# gdb 133859 in the raw QM9 layout, also the template of the synthetic benchmark molecules
+XYZ_STR = """18
+gdb 133859	3.63247	1.74015	1.47284	0.8183	82.97	-0.2044	-0.055	0.1494	927.4789	0.147108	-364.639427	-364.632258	-364.631314	-364.670376	29.576	
+C	5.3319053099	5.9009544883	-2.4481935796	-0.322109
+N	4.7662326987	4.8088964673	-3.2269812874	-0.144953
+C	3.4104288105	4.2745644534	-3.0770566853	-0.085299
+C	4.1568288286	3.3773972238	-1.2811264225	-0.117484
+C	3.066284219	2.4249831074	-1.6064327707	-0.006556
+C	3.4272619572	1.5850142432	-2.6115221676	-0.082832
+C	4.7932681306	2.0124467222	-3.1851479947	-0.33187
+C	4.6771526886	3.4929731507	-2.7094109329	0.240108
+C	2.8186619116	3.9471919481	-1.6799670799	-0.141848
+H	4.9433475067	6.8479772523	-2.8331991813	0.126132
+H	6.419056319	5.8969861248	-2.5753709525	0.126952
+H	5.1058036467	5.8327143997	-1.3753715582	0.116823
+H	2.8560706954	4.1578283815	-4.0028129045	0.095042
+H	4.6768855339	3.4171686098	-0.3331740759	0.09052
+H	2.7403974979	0.9899064946	-3.207908448	0.102606
+H	4.8100750993	1.8650381673	-4.2699905111	0.119558
+H	5.6834545589	1.5282483208	-2.7650993625	0.118542
+H	2.0954056876	4.5102041449	-1.1007688955	0.096668
+192.3698	199.4127	220.9295	317.1261	346.8427	406.4577	539.2391	587.2227	604.2042	699.6735	720.7176	732.4473	777.6982	836.3361	874.544	885.4446	918.0387	924.3724	950.9187	959.7899	998.2443	1040.9615	1052.7535	1085.6568	1113.2913	1144.6646	1156.5985	1181.0544	1210.1761	1222.4323	1244.552	1275.6402	1317.5534	1390.7834	1449.4037	1461.2503	1486.2974	1499.4246	1543.8878	3006.9222	3028.3271	3081.7677	3086.7582	3113.4146	3154.2406	3160.6454	3171.3195	3201.3403
+CN1C2C3C4=CCC13C24	CN1[C@H]2[C@@]31[C@@H]1[C]([CH]C3)[C@H]21	
+InChI=1S/C8H9N/c1-9-7-5-4-2-3-8(5,9)6(4)7/h2,5-7H,3H2,1H3	InChI=1S/C8H9N/c1-9-7-5-4-2-3-8(7,9)6(4)5/h2,5-7H,3H2,1H3/t5-,6+,7+,8-,9?/m0/s1
+"""
+
+
+def write_archive(archive_path: Path, members: dict[str, str]):
+    with tarfile.open(archive_path, "w:bz2") as tar:
+        for name, content in members.items():
+            data = content.encode("utf-8")
+            member = tarfile.TarInfo(name)
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+
+
 @pytest.fixture
 def parameter_fixture():
     element_h = "H"
@@ -34,30 +74,7 @@ def parameter_fixture():
 
 @pytest.fixture
 def xyz_fixture():
-    xyz_str = """18
-gdb 133859	3.63247	1.74015	1.47284	0.8183	82.97	-0.2044	-0.055	0.1494	927.4789	0.147108	-364.639427	-364.632258	-364.631314	-364.670376	29.576	
-C	5.3319053099	5.9009544883	-2.4481935796	-0.322109
-N	4.7662326987	4.8088964673	-3.2269812874	-0.144953
-C	3.4104288105	4.2745644534	-3.0770566853	-0.085299
-C	4.1568288286	3.3773972238	-1.2811264225	-0.117484
-C	3.066284219	2.4249831074	-1.6064327707	-0.006556
-C	3.4272619572	1.5850142432	-2.6115221676	-0.082832
-C	4.7932681306	2.0124467222	-3.1851479947	-0.33187
-C	4.6771526886	3.4929731507	-2.7094109329	0.240108
-C	2.8186619116	3.9471919481	-1.6799670799	-0.141848
-H	4.9433475067	6.8479772523	-2.8331991813	0.126132
-H	6.419056319	5.8969861248	-2.5753709525	0.126952
-H	5.1058036467	5.8327143997	-1.3753715582	0.116823
-H	2.8560706954	4.1578283815	-4.0028129045	0.095042
-H	4.6768855339	3.4171686098	-0.3331740759	0.09052
-H	2.7403974979	0.9899064946	-3.207908448	0.102606
-H	4.8100750993	1.8650381673	-4.2699905111	0.119558
-H	5.6834545589	1.5282483208	-2.7650993625	0.118542
-H	2.0954056876	4.5102041449	-1.1007688955	0.096668
-192.3698	199.4127	220.9295	317.1261	346.8427	406.4577	539.2391	587.2227	604.2042	699.6735	720.7176	732.4473	777.6982	836.3361	874.544	885.4446	918.0387	924.3724	950.9187	959.7899	998.2443	1040.9615	1052.7535	1085.6568	1113.2913	1144.6646	1156.5985	1181.0544	1210.1761	1222.4323	1244.552	1275.6402	1317.5534	1390.7834	1449.4037	1461.2503	1486.2974	1499.4246	1543.8878	3006.9222	3028.3271	3081.7677	3086.7582	3113.4146	3154.2406	3160.6454	3171.3195	3201.3403
-CN1C2C3C4=CCC13C24	CN1[C@H]2[C@@]31[C@@H]1[C]([CH]C3)[C@H]21	
-InChI=1S/C8H9N/c1-9-7-5-4-2-3-8(5,9)6(4)7/h2,5-7H,3H2,1H3	InChI=1S/C8H9N/c1-9-7-5-4-2-3-8(7,9)6(4)5/h2,5-7H,3H2,1H3/t5-,6+,7+,8-,9?/m0/s1
-"""
+    xyz_str = XYZ_STR
 
     xyz_str_with_sci_notation = """1
 foo
@@ -116,7 +133,9 @@ H 0.0 0.0 0.0
         ], dtype=torch.float32),
         "e": torch.tensor(edge_index),
         "a": None,
-        "g": None,
+        "g": torch.tensor([
+            [3.63247, 1.74015, 1.47284, 0.8183, 82.97, -0.2044, -0.055, 0.1494, 927.4789, 0.147108, -364.639427, -364.632258, -364.631314, -364.670376, 29.576],
+        ], dtype=torch.float64),
         "h_ctx": None,
         "x_ctx": None,
         "e_ctx": None,
@@ -194,3 +213,28 @@ def data_dict_fixture():
     return {
         "data_dict": data_dict,
     }
+
+
+@pytest.fixture
+def archive_fixture(tmp_path, xyz_fixture):
+    members = {
+        "dsgdb9nsd/dsgdb9nsd_000003.xyz": xyz_fixture["xyz_str"],
+        "dsgdb9nsd/dsgdb9nsd_000001.xyz": xyz_fixture["xyz_str_with_sci_notation"],
+        "dsgdb9nsd/dsgdb9nsd_000004.xyz": xyz_fixture["xyz_str_with_one_atom"],
+        "dsgdb9nsd/dsgdb9nsd_000002.xyz": "1\nfoo\nA 0.0 0.0 0.0\n",
+        "dsgdb9nsd/README": "foo\n",
+    }
+
+    archive_path = tmp_path / "dsgdb9nsd.xyz.tar.bz2"
+    write_archive(archive_path, members)
+
+    return {
+        "archive_path": archive_path,
+        "archive_sha256": hashlib.sha256(archive_path.read_bytes()).hexdigest(),
+        "xyz_strs": [
+            xyz_fixture["xyz_str_with_sci_notation"],
+            xyz_fixture["xyz_str"],
+            xyz_fixture["xyz_str_with_one_atom"],
+        ],
+        "dataset_dir_path": tmp_path / "dataset",
+    }
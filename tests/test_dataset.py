@@ -1,4 +1,17 @@
-from dataset_qm9_preprocessed.dataset import QM9Dataset
+import http.server
+import multiprocessing
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from torch.utils.data import DataLoader
+
+import dataset_qm9_preprocessed.dataset as dataset_module
+from dataset_qm9_preprocessed.dataset import BuildReport, QM9Dataset, QM9StreamingDataset, cache_key_from_options, dataset_cache_key, default_split_sizes, permutation_from_seed, raw_data_path_from_url, save_atomic
+from dataset_qm9_preprocessed.utils import collate_data_dicts, data_dict_from_xyz_str, xyz_str_from_data_dict
+from fixtures import *
 
 
 def test_dataset_len():
@@ -27,7 +40,7 @@ def test_dataset_getitem():
     assert x is not None, "Expected x, got None"
     assert e is not None, "Expected e, got None"
     assert a is None, f"Expected None, got {a}"
-    assert g is None, f"Expected None, got {g}"
+    assert g is not None, "Expected g, got None"
     assert h_ctx is None, f"Expected None, got {h_ctx}"
     assert x_ctx is None, f"Expected None, got {x_ctx}"
     assert e_ctx is None, f"Expected None, got {e_ctx}"
@@ -36,3 +49,434 @@ def test_dataset_getitem():
 
     assert h.shape[0] == x.shape[0], f"Expected h and x to be have the same first dimension, got h={h.shape[0]} and x={x.shape[0]}"
     assert x.shape[1] == 3, f"Expected x's second dimension to be 3, got {x.shape[1]}"
+    assert g.shape == (1, 15), f"Expected g's shape to be (1, 15), got {g.shape}"
+
+
+def test_dataset_property_stats(archive_fixture, xyz_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+
+    property_stats = dataset.property_stats
+    assert property_stats is not None, "Expected property stats, got None"
+    for key in ("mean", "std", "min", "max"):
+        assert property_stats[key].shape == (15,), f"Expected {key}'s shape to be (15,), got {property_stats[key].shape}"
+
+    # Only the gdb molecule of the archive has properties, the others are ignored
+    g = xyz_fixture["xyz_data_dict"]["g"][0]
+    for key in ("mean", "min", "max"):
+        assert torch.equal(property_stats[key], g), f"Output {key} is incorrect"
+
+    cached_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    assert torch.equal(cached_dataset.property_stats["mean"], property_stats["mean"]), "Expected the stats to be saved with the cache"
+
+
+def test_cache_key_from_options():
+    key = cache_key_from_options(url="foo", store_edges=True)
+    assert key == cache_key_from_options(store_edges=True, url="foo"), "Expected the same key for the same options"
+    assert key != cache_key_from_options(url="bar", store_edges=True), "Expected a different key for a different url"
+    assert key != cache_key_from_options(url="foo", store_edges=False), "Expected a different key for different options"
+
+
+def test_dataset_cache_key():
+    assert dataset_cache_key("foo", "ABC", cutoff=None) == dataset_cache_key("bar", "abc", cutoff=None), "Expected pinned mirrors to share a key"
+    assert dataset_cache_key("foo", cutoff=None) != dataset_cache_key("bar", cutoff=None), "Expected a different key for a different url"
+
+
+def test_raw_data_path_from_url(archive_fixture):
+    dataset_dir_path = archive_fixture["dataset_dir_path"]
+    assert raw_data_path_from_url("https://example.com/a/qm9.tar.bz2?x=1", dataset_dir_path) == dataset_dir_path / "raw" / "qm9.tar.bz2", "Output is incorrect"
+    assert raw_data_path_from_url("https://example.com/", dataset_dir_path) == dataset_dir_path / "raw" / "data.tar.bz2", "Output is incorrect"
+    assert raw_data_path_from_url(str(archive_fixture["archive_path"]), dataset_dir_path) == archive_fixture["archive_path"], "Expected local mirrors to be read in place"
+
+    # The streaming dataset reads and writes the same cache as the dataset it builds
+    url = "https://example.com/qm9.tar.bz2"
+    streaming_dataset = QM9StreamingDataset(url=url, dataset_dir_path=dataset_dir_path, cutoff=5.0)
+    assert streaming_dataset.raw_data_path == raw_data_path_from_url(url, dataset_dir_path), "Output is incorrect"
+    assert streaming_dataset.cache_key == dataset_cache_key(url, store_edges=True, shard_size=None, cutoff=5.0, max_num_neighbors=None), "Output is incorrect"
+
+
+def test_save_atomic(tmp_path):
+    path = tmp_path / "data.pth"
+    save_atomic({"a": torch.arange(3)}, path)
+    save_atomic({"a": torch.arange(4)}, path)
+
+    assert torch.equal(torch.load(path, weights_only=True)["a"], torch.arange(4)), "Output is incorrect"
+    assert [child.name for child in tmp_path.iterdir()] == ["data.pth"], "Expected no temporary files"
+
+
+def test_dataset_local_archive(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+
+    assert len(dataset) == 3, f"Expected dataset len to be 3, got {len(dataset)}"
+    for idx, xyz_str in enumerate(archive_fixture["xyz_strs"]):
+        data_dict = dataset[idx]
+        expected_data_dict = data_dict_from_xyz_str(xyz_str)
+        expected_x = expected_data_dict["x"] - torch.mean(expected_data_dict["x"], dim=0, keepdim=True)
+        assert torch.equal(data_dict["h"], expected_data_dict["h"]), "Output is incorrect"
+        assert torch.allclose(data_dict["x"], expected_x, atol=1e-6), "Output is incorrect"
+        assert torch.equal(data_dict["segments"], expected_data_dict["segments"]), "Output is incorrect"
+
+
+def test_dataset_cache_reuse(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    archive_fixture["archive_path"].unlink()
+    cached_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+
+    assert cached_dataset.dataset_data_path == dataset.dataset_data_path, "Expected the same cache file"
+    assert torch.equal(cached_dataset[1]["x"], dataset[1]["x"]), "Output is incorrect"
+
+
+def test_dataset_file_url_checksum(archive_fixture):
+    url = archive_fixture["archive_path"].as_uri()
+
+    dataset = QM9Dataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"], sha256=archive_fixture["archive_sha256"])
+    assert len(dataset) == 3, f"Expected dataset len to be 3, got {len(dataset)}"
+
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        QM9Dataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"], sha256="0" * 64, force_download=True)
+
+
+def test_dataset_shards(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    sharded_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=2)
+
+    assert sharded_dataset.num_shards == 2, f"Expected 2 shards, got {sharded_dataset.num_shards}"
+    assert len(sharded_dataset) == len(dataset), "Expected the same length"
+    assert torch.equal(sharded_dataset.num_nodes, dataset.num_nodes), "Expected the same atom counts"
+    for idx in range(len(dataset)):
+        assert torch.equal(sharded_dataset[idx]["x"], dataset[idx]["x"]), "Output is incorrect"
+        assert torch.equal(sharded_dataset[idx]["h"], dataset[idx]["h"]), "Output is incorrect"
+    assert torch.equal(sharded_dataset[-1]["x"], dataset[-1]["x"]), "Output is incorrect"
+
+    with pytest.raises(IndexError):
+        sharded_dataset[len(dataset)]
+
+
+def test_dataset_collate(archive_fixture):
+    url = str(archive_fixture["archive_path"])
+    indices = [2, 0, 1, 0]
+    for options in ({}, {"shard_size": 2}, {"cutoff": 2.0, "max_num_neighbors": 4, "store_edges": False}):
+        dataset = QM9Dataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"], **options)
+        collated_data_dict = dataset.collate(indices)
+        expected_data_dict = collate_data_dicts([dataset[idx] for idx in indices])
+        for key in ("h", "x", "e", "segments"):
+            assert torch.equal(collated_data_dict[key], expected_data_dict[key]), f"Output {key} is incorrect for {options}"
+        assert torch.equal(collated_data_dict["g"].nan_to_num(), expected_data_dict["g"].nan_to_num()), "Output is incorrect"
+
+    subset = QM9Dataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=2).select(max_num_heavy_atoms=0)
+    assert torch.equal(subset.collate([-1])["x"], subset[-1]["x"]), "Output is incorrect"
+    with pytest.raises(IndexError):
+        dataset.collate([len(dataset)])
+
+
+def test_dataset_build_report(archive_fixture):
+    stages = []
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], on_build_stage=lambda name, stage: stages.append(name))
+
+    report = dataset.build_report
+    assert stages == ["download", "decompress", "parse", "merge", "index", "save"], f"Expected every stage to be reported, got {stages}"
+    assert list(report.stages) == stages, "Output is incorrect"
+    assert report.num_molecules == 3, f"Expected 3 molecules, got {report.num_molecules}"
+    assert report.stages["download"]["bytes"] == archive_fixture["archive_path"].stat().st_size, "Output is incorrect"
+    assert report.stages["decompress"]["items"] == 4, "Output is incorrect"
+    assert report.stages["parse"]["items"] == 3, "Output is incorrect"
+    assert report.skipped == [{"name": "dsgdb9nsd/dsgdb9nsd_000002.xyz", "reason": "ValueError: Unknown element A"}], f"Output is incorrect, got {report.skipped}"
+
+    cached_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    assert cached_dataset.build_report == report, "Expected the saved report to be loaded with the cache"
+    assert BuildReport.load(dataset.dataset_report_path) == report, "Output is incorrect"
+
+
+def test_dataset_cutoff(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    radius_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], cutoff=2.0, max_num_neighbors=4)
+    on_access_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], cutoff=2.0, max_num_neighbors=4, store_edges=False)
+
+    assert radius_dataset.dataset_data_path != dataset.dataset_data_path, "Expected a different cache file for a different cutoff"
+    e = radius_dataset[1]["e"]
+    assert e.shape[1] < dataset[1]["e"].shape[1], "Expected fewer edges than the full graph"
+    assert torch.equal(on_access_dataset[1]["e"], e), "Expected stored and on access radius graphs to match"
+    assert radius_dataset[2]["e"] is None, "Expected no edges for a single atom"
+
+
+def test_default_split_sizes():
+    assert default_split_sizes(133885) == {"train": 100000, "valid": 20497, "test": 13388}, "Output is incorrect"
+    assert sum(default_split_sizes(50).values()) == 50, "Expected every molecule in a split"
+
+
+def test_dataset_split(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+
+    splits = dataset.split({"train": 2, "test": 1}, seed=1)
+    assert list(splits) == ["train", "test"], "Output is incorrect"
+    assert sorted(splits["train"].indices.tolist() + splits["test"].indices.tolist()) == [0, 1, 2], "Expected disjoint splits covering the dataset"
+    assert len(list(archive_fixture["dataset_dir_path"].glob("*.split-*.pth"))) == 1, "Expected the split to be saved next to the cache"
+
+    train = splits["train"]
+    idx = train.indices[0].item()
+    assert train[0]["x"].untyped_storage().data_ptr() == dataset.shard(0)["x"].untyped_storage().data_ptr(), "Expected views of the parent's storage"
+    assert torch.equal(train[0]["x"], dataset[idx]["x"]), "Output is incorrect"
+    assert torch.equal(train.num_nodes, dataset.num_nodes[train.indices]), "Output is incorrect"
+    assert torch.equal(train.__getitems__([1, 0])[0]["x"], dataset[train.indices[1].item()]["x"]), "Output is incorrect"
+
+    cached_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    assert torch.equal(cached_dataset.split({"train": 2, "test": 1}, seed=1)["train"].indices, train.indices), "Expected the same split in every process"
+    assert torch.equal(permutation_from_seed(3, 1), torch.cat([train.indices, splits["test"].indices])), "Output is incorrect"
+
+    assert sum(len(subset) for subset in dataset.split({"train": 0.5, "test": 0.5}).values()) == 2, "Output is incorrect"
+    with pytest.raises(ValueError, match="exceed"):
+        dataset.split({"train": 3, "test": 1})
+
+
+def test_dataset_export_xyz(archive_fixture, tmp_path):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=2)
+
+    assert dataset.export_xyz(tmp_path / "molecules.xyz", start=1, batch_size=1) == 2, "Output is incorrect"
+    expected_xyz_str = "".join(xyz_str_from_data_dict(dataset[idx]) for idx in (1, 2))
+    assert (tmp_path / "molecules.xyz").read_text() == expected_xyz_str, "Output is incorrect"
+
+
+def test_dataset_compact(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    compact_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], widen=False)
+
+    assert compact_dataset[0]["h"].dtype == torch.uint8, "Expected compact element indices"
+    assert dataset[0]["h"].dtype == torch.float32, "Expected one-hot rows"
+    collated_data_dict = collate_data_dicts([compact_dataset[idx] for idx in range(len(compact_dataset))])
+    expected_data_dict = collate_data_dicts([dataset[idx] for idx in range(len(dataset))])
+    for key in ("h", "x", "e", "segments"):
+        assert torch.equal(collated_data_dict[key], expected_data_dict[key]), f"Output {key} is incorrect"
+
+
+def test_dataset_lazy(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    assert dataset.shards == {}, "Expected no molecules to be loaded after a build"
+
+    lazy_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], mmap=True)
+    assert "h" not in lazy_dataset.packed_data, "Expected the cache file to hold only the index"
+    assert len(lazy_dataset) == 3, f"Expected dataset len to be 3, got {len(lazy_dataset)}"
+    assert lazy_dataset.num_nodes.tolist() == [1, 18, 1], "Output is incorrect"
+    assert lazy_dataset.properties.shape == (3, 15), "Output is incorrect"
+    assert lazy_dataset.shards == {}, "Expected metadata to be read from the index only"
+
+    assert torch.equal(lazy_dataset[1]["x"], dataset[1]["x"]), "Output is incorrect"
+    assert list(lazy_dataset.shards) == [0], "Expected the shard to be opened on first access"
+
+
+def test_dataset_import_is_lazy():
+    code = "import sys, dataset_qm9_preprocessed.dataset; print(any(name in sys.modules for name in ('requests', 'concurrent.futures.process')))"
+    assert subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.strip() == "False", "Expected build dependencies to be imported lazily"
+
+
+def test_streaming_dataset(archive_fixture):
+    streaming_dataset = QM9StreamingDataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    with pytest.warns(UserWarning, match="Skipped 1 invalid molecules"):
+        data_dicts = list(streaming_dataset)
+    assert streaming_dataset.skipped == [{"name": "dsgdb9nsd/dsgdb9nsd_000002.xyz", "reason": "ValueError: Unknown element A"}], f"Output is incorrect, got {streaming_dataset.skipped}"
+    assert streaming_dataset.build_process.wait(timeout=120) == 0, streaming_dataset.dataset_log_path.read_text()
+
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    assert dataset.build_report.stages, "Expected the cache to be written in the background"
+    assert sorted(data_dict["segments"].item() for data_dict in data_dicts) == sorted(dataset.num_nodes.tolist()), "Expected every valid molecule exactly once"
+    data_dict = next(data_dict for data_dict in data_dicts if data_dict["segments"].item() == 18)
+    assert torch.allclose(data_dict["x"], dataset[1]["x"], atol=1e-6), "Output is incorrect"
+    assert torch.equal(data_dict["h"], dataset[1]["h"]), "Output is incorrect"
+    assert torch.equal(data_dict["e"], dataset[1]["e"]), "Output is incorrect"
+
+    cached_data_dicts = list(streaming_dataset)
+    assert [data_dict["segments"].item() for data_dict in cached_data_dicts] == dataset.num_nodes.tolist(), "Expected the cache to be read once written"
+
+
+def test_streaming_dataset_checksum(archive_fixture):
+    url = str(archive_fixture["archive_path"])
+    streaming_dataset = QM9StreamingDataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"], sha256="0" * 64, write_cache=False)
+    with pytest.raises(RuntimeError, match="Checksum mismatch"):
+        list(streaming_dataset)
+
+    streaming_dataset = QM9StreamingDataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"], sha256=archive_fixture["archive_sha256"], write_cache=False)
+    with pytest.warns(UserWarning, match="Skipped 1 invalid molecules"):
+        assert len(list(streaming_dataset)) == 3, "Output is incorrect"
+    assert streaming_dataset.verified, "Expected the local mirror to be verified"
+
+
+def test_streaming_dataset_shuffle(archive_fixture):
+    streaming_dataset = QM9StreamingDataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], write_cache=False)
+    shuffled_dataset = QM9StreamingDataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shuffle_buffer_size=2, seed=1, write_cache=False)
+
+    with pytest.warns(UserWarning):
+        data_dicts = list(streaming_dataset)
+        shuffled_data_dicts = list(shuffled_dataset)
+    assert streaming_dataset.build_process is None, "Expected no cache to be written"
+    assert sorted(data_dict["x"].sum().item() for data_dict in shuffled_data_dicts) == sorted(data_dict["x"].sum().item() for data_dict in data_dicts), "Expected a permutation of the stream"
+    assert [data_dict["x"].sum().item() for data_dict in shuffled_data_dicts] == [data_dict["x"].sum().item() for data_dict in shuffled_dataset], "Expected the same order for the same seed and epoch"
+
+
+def test_streaming_dataset_http(archive_fixture):
+    archive_bytes = archive_fixture["archive_path"].read_bytes()
+    requests_paths = []
+
+    class ArchiveHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_paths.append(self.path)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(archive_bytes)))
+            self.end_headers()
+            # Send the archive slowly so workers stream it while it downloads
+            for start in range(0, len(archive_bytes), 256):
+                self.wfile.write(archive_bytes[start:start + 256])
+                time.sleep(0.01)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ArchiveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/dsgdb9nsd.xyz.tar.bz2"
+        streaming_dataset = QM9StreamingDataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"])
+        data_loader = DataLoader(streaming_dataset, batch_size=None, num_workers=2)
+        assert sorted(data_dict["segments"].item() for data_dict in data_loader) == [1, 1, 18], "Expected every valid molecule exactly once"
+
+        # The cache build outlives the workers that started it
+        deadline = time.monotonic() + 120
+        while not streaming_dataset.dataset_data_path.exists() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert len(QM9Dataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"])) == 3, "Expected the cache to be built in the background"
+        assert requests_paths == ["/dsgdb9nsd.xyz.tar.bz2"], f"Expected a single download, got {requests_paths}"
+    finally:
+        server.shutdown()
+
+
+def test_dataset_download_retries(archive_fixture):
+    archive_bytes = archive_fixture["archive_path"].read_bytes()
+    statuses = []
+
+    class FlakyHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/missing"):
+                statuses.append(404)
+                self.send_error(404)
+                return
+            # Refuse the first request as overloaded, then serve the archive
+            if not statuses:
+                statuses.append(503)
+                self.send_response(503)
+                self.send_header("Retry-After", "0")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            statuses.append(200)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(archive_bytes)))
+            self.end_headers()
+            self.wfile.write(archive_bytes)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/dsgdb9nsd.xyz.tar.bz2"
+        dataset = QM9Dataset(url=url, dataset_dir_path=archive_fixture["dataset_dir_path"], sha256=archive_fixture["archive_sha256"], retries=2)
+        assert len(dataset) == 3, "Output is incorrect"
+        assert statuses == [503, 200], f"Expected a retry after the 503, got {statuses}"
+
+        # Client errors fail without retrying
+        statuses.clear()
+        raw_data_path = archive_fixture["dataset_dir_path"] / "raw" / "missing.tar.bz2"
+        with pytest.raises(RuntimeError, match="HTTP 404"):
+            dataset_module.download_archive(f"http://127.0.0.1:{server.server_address[1]}/missing.tar.bz2", raw_data_path, retries=2)
+        assert statuses == [404], f"Expected a single request, got {statuses}"
+    finally:
+        server.shutdown()
+
+
+def test_dataset_key_index(archive_fixture, xyz_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    assert dataset.key_tables is None, "Expected the key index to be read on the first lookup"
+    assert dataset.gdb_ids.tolist() == [-1, 133859, -1], "Output is incorrect"
+
+    assert dataset.index_of(gdb_id=133859) == 1, "Output is incorrect"
+    assert dataset.index_of(gdb_id=1) is None, "Expected no molecule"
+    assert dataset.index_of(smiles="CN1C2C3C4=CCC13C24") == 1, "Output is incorrect"
+    assert dataset.index_of(inchi="InChI=1S/C8H9N/c1-9-7-5-4-2-3-8(5,9)6(4)7/h2,5-7H,3H2,1H3") == 1, "Output is incorrect"
+    assert dataset.lookup_smiles("CN1C2C3C4=CCC13C24") == [1], "Output is incorrect"
+    assert dataset.lookup_inchi("InChI=1S/CH4/h1H4") == [], "Expected no molecule"
+    assert dataset.contains(gdb_ids=[133859, 0, -1, 1 << 40]).tolist() == [True, False, False, False], "Output is incorrect"
+    assert dataset.indices_of(smiles=["C", "CN1C2C3C4=CCC13C24", ""]).tolist() == [-1, 1, -1], "Output is incorrect"
+    assert torch.equal(dataset[dataset.index_of(gdb_id=133859)]["h"], data_dict_from_xyz_str(xyz_fixture["xyz_str"])["h"]), "Output is incorrect"
+
+    with pytest.raises(ValueError, match="Exactly one of"):
+        dataset.index_of(gdb_id=1, smiles="C")
+
+
+def test_dataset_select(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    assert dataset.element_counts.tolist() == [[1, 0, 0, 0, 0], [9, 8, 1, 0, 0], [1, 0, 0, 0, 0]], "Output is incorrect"
+    assert dataset.composition()["num_heavy_atoms"].tolist() == [0, 9, 0], "Output is incorrect"
+
+    subset = dataset.select(formula="C8H9N")
+    assert subset.indices.tolist() == [1], "Output is incorrect"
+    assert dataset.shards == {}, "Expected selection to read the index only"
+    assert torch.equal(subset[0]["x"], dataset[1]["x"]), "Output is incorrect"
+    assert dataset.select(exclude_elements=["N"], max_num_heavy_atoms=9).indices.tolist() == [0, 2], "Output is incorrect"
+    assert dataset.select(predicate=lambda columns: columns["H"] == 1).indices.tolist() == [0, 2], "Output is incorrect"
+
+    split = dataset.split({"train": 2, "test": 1}, seed=0)
+    train_subset = split["train"].select(include_elements=["C"])
+    assert train_subset.indices.tolist() == [idx for idx in split["train"].indices.tolist() if idx == 1], "Expected the filter to apply within the split"
+
+
+def build_dataset_in_process(archive_path, dataset_dir_path, barrier, results):
+    barrier.wait()
+    try:
+        results.put(len(QM9Dataset(url=str(archive_path), dataset_dir_path=dataset_dir_path)))
+    except Exception as e:
+        results.put(repr(e))
+
+
+def test_dataset_concurrent_build(xyz_fixture, tmp_path, monkeypatch):
+    # Many small chunks so concurrent builders overlap on the checkpoint directory
+    archive_path = tmp_path / "dsgdb9nsd.xyz.tar.bz2"
+    write_archive(archive_path, {f"dsgdb9nsd_{idx:06d}.xyz": xyz_fixture["xyz_str"] for idx in range(2048)})
+    monkeypatch.setattr(dataset_module, "CHUNK_SIZE", 8)
+
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(4)
+    results = context.Queue()
+    processes = [context.Process(target=build_dataset_in_process, args=(archive_path, tmp_path / "dataset", barrier, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert sorted(results.get() for _ in processes) == [2048] * 4, "Expected every process to load the cache"
+    assert len(QM9Dataset(url=str(archive_path), dataset_dir_path=tmp_path / "dataset")) == 2048, "Output is incorrect"
+
+
+def test_dataset_rebuild_keeps_shards(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=1)
+    x = dataset[2]["x"]
+
+    # A forced rebuild writes new shards next to the ones the open dataset still reads lazily
+    rebuilt_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=1, force_download=True)
+    assert rebuilt_dataset.packed_data["shard_dir"] != dataset.packed_data["shard_dir"], "Expected the rebuild to use a new shard directory"
+    assert torch.equal(dataset[1]["x"], rebuilt_dataset[1]["x"]), "Expected the old shards to stay readable"
+    assert torch.equal(rebuilt_dataset[2]["x"], x), "Output is incorrect"
+
+    # Losing shards invalidates the index so the cache repairs itself
+    shutil.rmtree(rebuilt_dataset.dataset_shard_dir_path / rebuilt_dataset.packed_data["shard_dir"])
+    stages = []
+    repaired_dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=1, on_build_stage=lambda name, stage: stages.append(name))
+    assert stages, "Expected the cache to be rebuilt"
+    assert torch.equal(repaired_dataset[2]["x"], x), "Output is incorrect"
+    assert [path.name for path in repaired_dataset.dataset_shard_dir_path.iterdir()] == [repaired_dataset.packed_data["shard_dir"]], "Expected shards no index refers to to be removed"
+
+
+def test_dataset_without_properties(xyz_fixture, tmp_path):
+    archive_path = tmp_path / "dsgdb9nsd.xyz.tar.bz2"
+    write_archive(archive_path, {"dsgdb9nsd_000001.xyz": xyz_fixture["xyz_str_with_one_atom"]})
+
+    dataset = QM9Dataset(url=str(archive_path), dataset_dir_path=tmp_path / "dataset")
+    assert dataset.property_stats is None, "Expected no property stats without properties"
+    assert torch.isnan(dataset[0]["g"]).all(), "Expected a NaN row for a molecule without properties"
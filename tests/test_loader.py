@@ -0,0 +1,75 @@
+import threading
+
+from dataset_qm9_preprocessed.dataset import QM9Dataset
+from dataset_qm9_preprocessed.loader import QM9PrefetchLoader
+from dataset_qm9_preprocessed.sampler import QM9BatchSampler
+from dataset_qm9_preprocessed.utils import collate_data_dicts
+from fixtures import *
+
+
+@pytest.fixture
+def loader_fixture(archive_fixture):
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"])
+    return {
+        "dataset": dataset,
+    }
+
+
+def test_prefetch_loader(loader_fixture):
+    dataset = loader_fixture["dataset"]
+
+    loader = QM9PrefetchLoader(dataset, batch_size=2, pin_memory=False, device="cpu")
+    data_dicts = list(loader)
+
+    assert len(data_dicts) == len(loader) == 2, f"Expected 2 batches, got {len(data_dicts)}"
+    for data_dict, batch in zip(data_dicts, [[0, 1], [2]]):
+        expected_data_dict = collate_data_dicts([dataset[idx] for idx in batch])
+        for key in ("h", "x", "e", "segments"):
+            assert torch.equal(data_dict[key], expected_data_dict[key]), "Output is incorrect"
+        assert torch.equal(data_dict["g"].nan_to_num(), expected_data_dict["g"].nan_to_num()), "Output is incorrect"
+    assert loader.num_batches == 2, f"Expected 2 batches, got {loader.num_batches}"
+    assert loader.stall_time >= 0.0, "Output is incorrect"
+    assert loader.queue_depth == 0, "Expected an empty queue after the last batch"
+
+
+def test_prefetch_loader_batch_sampler(loader_fixture):
+    dataset = loader_fixture["dataset"]
+
+    batch_sampler = QM9BatchSampler(dataset, max_batch_size=1, seed=1)
+    loader = QM9PrefetchLoader(dataset, batch_sampler=batch_sampler, pin_memory=False)
+    loader.set_epoch(3)
+
+    assert batch_sampler.epoch == 3, "Expected the epoch to be forwarded to the batch sampler"
+    assert [data_dict["segments"].tolist() for data_dict in loader] == [dataset.num_nodes[batch].tolist() for batch in batch_sampler], "Output is incorrect"
+
+
+def test_prefetch_loader_early_exit(loader_fixture):
+    dataset = loader_fixture["dataset"]
+
+    loader = QM9PrefetchLoader(dataset, batch_size=1, prefetch=1, pin_memory=False)
+    for _ in loader:
+        break
+    assert threading.active_count() == 1, "Expected the background thread to stop"
+    assert len(list(loader)) == 3, "Expected a new iteration to start from the beginning"
+
+
+def test_prefetch_loader_raises(loader_fixture):
+    dataset = loader_fixture["dataset"]
+
+    loader = QM9PrefetchLoader(dataset, batch_sampler=[[0], [len(dataset)]], pin_memory=False)
+    with pytest.raises(IndexError):
+        list(loader)
+    with pytest.raises(ValueError, match="Invalid prefetch"):
+        QM9PrefetchLoader(dataset, prefetch=0)
+
+
+def test_prefetch_loader_producer_died(loader_fixture):
+    dataset = loader_fixture["dataset"]
+
+    def collate_fn(data_dicts):
+        # Exceptions outside Exception escape the producer without being queued
+        raise SystemExit
+
+    loader = QM9PrefetchLoader(dataset, batch_size=1, collate_fn=collate_fn, pin_memory=False)
+    with pytest.raises(RuntimeError, match="Batch producer stopped"):
+        list(loader)
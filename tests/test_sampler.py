@@ -0,0 +1,169 @@
+from torch.utils.data import DataLoader, Dataset
+
+from dataset_qm9_preprocessed.dataset import QM9Dataset
+from dataset_qm9_preprocessed.sampler import QM9BatchSampler, QM9DistributedSampler
+from dataset_qm9_preprocessed.utils import collate_data_dicts, data_dict_from_packed_data, packed_data_from_xyz_strs
+from fixtures import *
+
+
+class PackedDataset(Dataset):
+    def __init__(self, num_nodes: list[int]):
+        xyz_strs = [f"{n}\nfoo\n" + "".join(f"C {i}.0 0.0 0.0\n" for i in range(n)) for n in num_nodes]
+        self.packed_data = packed_data_from_xyz_strs(xyz_strs)
+
+    @property
+    def num_nodes(self):
+        return self.packed_data["segments"]
+
+    def __len__(self):
+        return self.packed_data["segments"].shape[0]
+
+    def __getitem__(self, idx):
+        return data_dict_from_packed_data(self.packed_data, idx)
+
+
+@pytest.fixture
+def sampler_fixture():
+    num_nodes = torch.randint(3, 30, (500,), generator=torch.Generator().manual_seed(0)).tolist()
+    return {
+        "dataset": PackedDataset(num_nodes),
+        "num_nodes": num_nodes,
+    }
+
+
+def test_batch_sampler_covers_dataset(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+    sampler = QM9BatchSampler(dataset, max_num_nodes=256)
+
+    indices = [idx for batch in sampler for idx in batch]
+    assert sorted(indices) == list(range(len(dataset))), "Expected every molecule exactly once"
+    assert len(sampler) == len(list(sampler)), "Length is incorrect"
+
+
+def test_batch_sampler_budget(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+    num_nodes = sampler_fixture["num_nodes"]
+
+    sampler = QM9BatchSampler(dataset, max_num_nodes=256, max_num_edges=4096, max_batch_size=64)
+    for batch in sampler:
+        assert sum(num_nodes[idx] for idx in batch) <= 256, "Node budget exceeded"
+        assert sum(num_nodes[idx] * (num_nodes[idx] - 1) for idx in batch) <= 4096, "Edge budget exceeded"
+        assert len(batch) <= 64, "Batch size exceeded"
+
+
+def test_batch_sampler_buckets(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+    num_nodes = sampler_fixture["num_nodes"]
+
+    sampler = QM9BatchSampler(dataset, max_num_edges=4096, bucket_width=4)
+    for batch in sampler:
+        assert len({(num_nodes[idx] - 1) // 4 for idx in batch}) == 1, "Expected molecules from a single bucket"
+
+
+def test_batch_sampler_deterministic(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+
+    sampler = QM9BatchSampler(dataset, max_num_nodes=256, seed=1)
+    other_sampler = QM9BatchSampler(dataset, max_num_nodes=256, seed=1)
+    assert list(sampler) == list(other_sampler), "Expected the same batches for the same seed and epoch"
+
+    sampler.set_epoch(1)
+    assert list(sampler) != list(other_sampler), "Expected different batches for a different epoch"
+
+    other_sampler.set_epoch(1)
+    assert list(sampler) == list(other_sampler), "Expected the same batches for the same seed and epoch"
+
+
+def test_batch_sampler_raises(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+    with pytest.raises(ValueError, match="At least one of"):
+        QM9BatchSampler(dataset)
+
+
+def test_batch_sampler_data_loader(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+
+    sampler = QM9BatchSampler(dataset, max_num_nodes=256)
+    data_loader = DataLoader(dataset, batch_sampler=sampler, collate_fn=collate_data_dicts)
+
+    num_molecules = 0
+    for batch, data_dict in zip(sampler, data_loader):
+        assert data_dict["segments"].tolist() == dataset.num_nodes[batch].tolist(), "Output is incorrect"
+        num_molecules += len(batch)
+    assert num_molecules == len(dataset), "Expected every molecule exactly once"
+
+
+def test_distributed_sampler_partition(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+
+    samplers = [QM9DistributedSampler(dataset, num_replicas=3, rank=rank, seed=1) for rank in range(3)]
+    rank_indices = [list(sampler) for sampler in samplers]
+
+    assert [len(indices) for indices in rank_indices] == [167, 167, 167], "Expected the same number of samples on every rank"
+    assert sorted(set().union(*rank_indices)) == list(range(len(dataset))), "Expected every molecule on some rank"
+    for rank, indices in enumerate(rank_indices):
+        assert min(indices) >= rank * 500 // 3 and max(indices) < (rank + 1) * 500 // 3, "Expected a contiguous range per rank"
+
+    drop_last_samplers = [QM9DistributedSampler(dataset, num_replicas=3, rank=rank, drop_last=True) for rank in range(3)]
+    assert [len(list(sampler)) for sampler in drop_last_samplers] == [166, 166, 166], "Expected the same number of samples on every rank"
+
+
+def test_distributed_sampler_deterministic(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+
+    sampler = QM9DistributedSampler(dataset, num_replicas=2, rank=1, seed=1)
+    other_sampler = QM9DistributedSampler(dataset, num_replicas=2, rank=1, seed=1)
+    assert list(sampler) == list(other_sampler), "Expected the same order for the same seed and epoch"
+
+    sampler.set_epoch(1)
+    assert list(sampler) != list(other_sampler), "Expected a different order for a different epoch"
+    assert sorted(sampler) == sorted(other_sampler), "Expected the same molecules for every epoch"
+
+
+def test_distributed_sampler_raises(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+    with pytest.raises(ValueError, match="num_replicas and rank are required"):
+        QM9DistributedSampler(dataset)
+    with pytest.raises(ValueError, match="Invalid rank"):
+        QM9DistributedSampler(dataset, num_replicas=2, rank=2)
+
+
+def test_distributed_sampler_shards(archive_fixture):
+    QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=1)
+    dataset = QM9Dataset(url=str(archive_fixture["archive_path"]), dataset_dir_path=archive_fixture["dataset_dir_path"], shard_size=1)
+    assert dataset.num_shards == 3, f"Expected 3 shards, got {dataset.num_shards}"
+
+    sampler = QM9DistributedSampler(dataset, num_replicas=2, rank=0)
+    assert sampler.shard_indices == [0], "Output is incorrect"
+    assert QM9DistributedSampler(dataset, num_replicas=2, rank=1).shard_indices == [1, 2], "Output is incorrect"
+
+    for idx in sampler:
+        dataset[idx]
+    assert list(dataset.shards) == [0], "Expected only the rank's shards to be opened"
+
+
+def test_distributed_sampler_more_replicas_than_molecules():
+    dataset = PackedDataset([3, 4, 5])
+
+    samplers = [QM9DistributedSampler(dataset, num_replicas=4, rank=rank) for rank in range(4)]
+    rank_indices = [list(sampler) for sampler in samplers]
+    assert [len(indices) for indices in rank_indices] == [len(sampler) for sampler in samplers] == [1, 1, 1, 1], "Expected the same number of samples on every rank"
+    assert set().union(*rank_indices) == {0, 1, 2}, "Expected every molecule on some rank"
+
+    drop_last_samplers = [QM9DistributedSampler(dataset, num_replicas=4, rank=rank, drop_last=True) for rank in range(4)]
+    assert [len(list(sampler)) for sampler in drop_last_samplers] == [len(sampler) for sampler in drop_last_samplers] == [0, 0, 0, 0], "Output is incorrect"
+
+
+def test_batch_sampler_caches_batches(sampler_fixture):
+    dataset = sampler_fixture["dataset"]
+
+    sampler = QM9BatchSampler(dataset, max_num_nodes=256, seed=1)
+    batches = sampler.batches()
+    assert len(sampler) == len(batches), "Length is incorrect"
+    assert sampler.batches() is batches, "Expected the batches to be reused for the same epoch"
+
+    sampler.set_epoch(1)
+    assert sampler.batches() is not batches and sampler.batches() != batches, "Expected new batches for a new epoch"
+    other_sampler = QM9BatchSampler(dataset, max_num_nodes=256, seed=1)
+    other_sampler.set_epoch(1)
+    assert list(sampler) == other_sampler.build_batches(), "Expected the cached batches to match a fresh build"
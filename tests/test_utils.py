@@ -1,4 +1,4 @@
-from dataset_qm9_preprocessed.utils import onehot_from_element, element_from_onehot, data_dict_from_xyz_str, xyz_str_from_data_dict, collate_data_dicts
+from dataset_qm9_preprocessed.utils import onehot_from_element, element_from_onehot, data_dict_from_xyz_str, xyz_str_from_data_dict, collate_data_dicts, packed_data_from_data_dicts, data_dict_from_packed_data, concat_packed_data, arrays_from_xyz_str, edge_index_from_num_nodes, packed_data_from_xyz_strs, collate_data_dicts_dense, MAX_NUM_NODES, property_stats_from_properties, PROPERTY_NAMES, slice_packed_data, radius_edge_index_from_positions, xyz_strs_from_data_dict, write_xyz, center_positions, random_rotation_matrices, rotate_data_dict, widen_data_dict, keys_from_xyz_str, key_hashes_from_strs, hash_table_from_key_hashes, indices_from_hash_table, gdb_table_from_gdb_ids, element_counts_from_packed_data, element_masks_from_element_counts, element_counts_from_formula, composition_mask, collate_packed_data, gather_packed_data
 from fixtures import *
 
 
@@ -132,7 +132,7 @@ def test_data_dict_from_xyz_str_output_value(xyz_fixture):
     assert torch.equal(data_dict["x"], xyz_data_dict["x"]), "Output is incorrect"
     assert torch.equal(data_dict["e"], xyz_data_dict["e"]), "Output is incorrect"
     assert data_dict["a"] == xyz_data_dict["a"], "Output is incorrect"
-    assert data_dict["g"] == xyz_data_dict["g"], "Output is incorrect"
+    assert torch.equal(data_dict["g"], xyz_data_dict["g"]), "Output is incorrect"
     assert data_dict["h_ctx"] == xyz_data_dict["h_ctx"], "Output is incorrect"
     assert data_dict["x_ctx"] == xyz_data_dict["x_ctx"], "Output is incorrect"
     assert data_dict["e_ctx"] == xyz_data_dict["e_ctx"], "Output is incorrect"
@@ -317,3 +317,505 @@ def test_collate_data_dicts_value(data_dict_fixture):
         [1.0, 2.0, 3.0, 4.0, 5.0],
     ])), "Output is incorrect"
     assert torch.equal(collated_data_dict["segments"], torch.tensor([3, 3])), "Output is incorrect"
+
+
+def test_packed_data_from_data_dicts_value(xyz_fixture):
+    xyz_data_dict = data_dict_from_xyz_str(xyz_fixture["xyz_str"])
+    one_atom_data_dict = data_dict_from_xyz_str(xyz_fixture["xyz_str_with_one_atom"])
+
+    packed_data = packed_data_from_data_dicts([xyz_data_dict, one_atom_data_dict, xyz_data_dict])
+
+    assert packed_data["h"].shape == (37,), "Output shape is incorrect"
+    assert packed_data["x"].shape == (37, 3), "Output shape is incorrect"
+    assert packed_data["e"].shape == (2, 2 * 306), "Output shape is incorrect"
+    assert packed_data["h"].dtype == torch.uint8, "Expected compact element indices"
+    assert packed_data["e"].dtype == torch.int16, "Expected compact edges"
+    assert packed_data["segments"].dtype == torch.int16, "Expected compact segments"
+    assert packed_data["node_offsets"].dtype == torch.int32, "Expected compact offsets"
+    assert packed_data["h"][:3].tolist() == [1, 2, 1], "Output is incorrect"
+    assert torch.equal(packed_data["segments"], torch.tensor([18, 1, 18])), "Output is incorrect"
+    assert torch.equal(packed_data["node_offsets"], torch.tensor([0, 18, 19, 37])), "Output is incorrect"
+    assert torch.equal(packed_data["edge_offsets"], torch.tensor([0, 306, 306, 612])), "Output is incorrect"
+
+
+def test_data_dict_from_packed_data_inverse(xyz_fixture):
+    xyz_data_dict = data_dict_from_xyz_str(xyz_fixture["xyz_str"])
+    one_atom_data_dict = data_dict_from_xyz_str(xyz_fixture["xyz_str_with_one_atom"])
+    data_dicts = [xyz_data_dict, one_atom_data_dict, xyz_data_dict]
+
+    packed_data = packed_data_from_data_dicts(data_dicts)
+
+    for idx, data_dict in enumerate(data_dicts):
+        unpacked_data_dict = data_dict_from_packed_data(packed_data, idx)
+        assert torch.equal(unpacked_data_dict["h"], data_dict["h"]), "Inverse failed"
+        assert torch.equal(unpacked_data_dict["x"], data_dict["x"]), "Inverse failed"
+        if data_dict["e"] is None:
+            assert unpacked_data_dict["e"] is None, "Inverse failed"
+        else:
+            assert torch.equal(unpacked_data_dict["e"], data_dict["e"]), "Inverse failed"
+        assert torch.equal(unpacked_data_dict["segments"], data_dict["segments"]), "Inverse failed"
+        assert unpacked_data_dict["a"] is None, "Inverse failed"
+        assert torch.equal(unpacked_data_dict["g"].nan_to_num(), data_dict["g"].nan_to_num()), "Inverse failed"
+
+    unpacked_data_dict = data_dict_from_packed_data(packed_data, -1)
+    assert torch.equal(unpacked_data_dict["h"], xyz_data_dict["h"]), "Negative index failed"
+
+
+def test_data_dict_from_packed_data_shares_storage(xyz_fixture):
+    packed_data = packed_data_from_data_dicts([data_dict_from_xyz_str(xyz_fixture["xyz_str"])])
+    data_dict = data_dict_from_packed_data(packed_data, 0, widen=False)
+    assert data_dict["h"].untyped_storage().data_ptr() == packed_data["h"].untyped_storage().data_ptr(), "Expected a view"
+    assert data_dict["x"].untyped_storage().data_ptr() == packed_data["x"].untyped_storage().data_ptr(), "Expected a view"
+    assert data_dict["e"].untyped_storage().data_ptr() == packed_data["e"].untyped_storage().data_ptr(), "Expected a view"
+
+    data_dict = data_dict_from_packed_data(packed_data, 0)
+    assert data_dict["x"].untyped_storage().data_ptr() == packed_data["x"].untyped_storage().data_ptr(), "Expected a view"
+
+
+def test_data_dict_from_packed_data_raises(xyz_fixture):
+    packed_data = packed_data_from_data_dicts([data_dict_from_xyz_str(xyz_fixture["xyz_str"])])
+    with pytest.raises(IndexError):
+        data_dict_from_packed_data(packed_data, 1)
+
+
+def test_concat_packed_data_value(xyz_fixture):
+    xyz_data_dict = data_dict_from_xyz_str(xyz_fixture["xyz_str"])
+    one_atom_data_dict = data_dict_from_xyz_str(xyz_fixture["xyz_str_with_one_atom"])
+    data_dicts = [xyz_data_dict, one_atom_data_dict, xyz_data_dict, one_atom_data_dict]
+
+    packed_data = packed_data_from_data_dicts(data_dicts)
+    concatenated_packed_data = concat_packed_data([
+        packed_data_from_data_dicts(data_dicts[:1]),
+        packed_data_from_data_dicts(data_dicts[1:2]),
+        packed_data_from_data_dicts([]),
+        packed_data_from_data_dicts(data_dicts[2:]),
+    ])
+
+    for key in ("h", "x", "e", "segments", "node_offsets", "edge_offsets"):
+        assert torch.equal(packed_data[key], concatenated_packed_data[key]), f"Output {key} is incorrect"
+
+
+def test_arrays_from_xyz_str_value(xyz_fixture):
+    xyz_data_dict = xyz_fixture["xyz_data_dict"]
+
+    elements, coordinates, properties = arrays_from_xyz_str(xyz_fixture["xyz_str"])
+
+    assert elements.tolist() == xyz_data_dict["h"].argmax(dim=1).tolist(), "Output is incorrect"
+    assert torch.equal(torch.from_numpy(coordinates).to(torch.float32), xyz_data_dict["x"]), "Output is incorrect"
+    assert torch.equal(torch.from_numpy(properties)[None], xyz_data_dict["g"]), "Output is incorrect"
+
+    _, _, properties = arrays_from_xyz_str(xyz_fixture["xyz_str_with_one_atom"])
+    assert properties.shape == (len(PROPERTY_NAMES),) and torch.isnan(torch.from_numpy(properties)).all(), "Expected a NaN row for a molecule without properties"
+
+
+def test_arrays_from_xyz_str_raises():
+    with pytest.raises(ValueError, match="Unknown element A"):
+        arrays_from_xyz_str("1\nfoo\nA 0.0 0.0 0.0\n")
+
+    with pytest.raises(ValueError, match="Invalid number of atoms"):
+        arrays_from_xyz_str("2\nfoo\nH 0.0 0.0 0.0\n")
+
+    with pytest.raises(ValueError):
+        arrays_from_xyz_str("1\nfoo\nH 0.0 0.0\n")
+
+    with pytest.raises(ValueError, match="Invalid properties"):
+        arrays_from_xyz_str("1\ngdb 1 0.0 0.0\nH 0.0 0.0 0.0\n")
+
+
+def test_edge_index_from_num_nodes_value():
+    assert edge_index_from_num_nodes(1) is None, "Output is incorrect"
+
+    for num_nodes in range(2, 30):
+        edges = list(itertools.combinations(range(num_nodes), 2))
+        src, dst = zip(*edges)
+        assert torch.equal(edge_index_from_num_nodes(num_nodes), torch.tensor([src + dst, dst + src])), "Output is incorrect"
+
+
+def test_packed_data_from_xyz_strs_value(xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str_with_sci_notation"]]
+
+    packed_data = packed_data_from_xyz_strs(xyz_strs)
+    expected_packed_data = packed_data_from_data_dicts([data_dict_from_xyz_str(xyz_str) for xyz_str in xyz_strs])
+
+    for key in ("h", "x", "e", "segments", "node_offsets", "edge_offsets"):
+        assert torch.equal(packed_data[key], expected_packed_data[key]), f"Output {key} is incorrect"
+
+
+def test_packed_data_from_xyz_strs_on_error(xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], "1\nfoo\nA 0.0 0.0 0.0\n", xyz_fixture["xyz_str_with_one_atom"]]
+
+    with pytest.raises(ValueError, match="Unknown element A"):
+        packed_data_from_xyz_strs(xyz_strs)
+
+    errors = []
+    packed_data = packed_data_from_xyz_strs(xyz_strs, on_error=lambda index, error: errors.append(index))
+    assert errors == [1], "Expected the invalid molecule to be reported"
+    assert torch.equal(packed_data["segments"], torch.tensor([18, 1])), "Expected the invalid molecule to be skipped"
+
+
+def test_packed_data_from_xyz_strs_without_edges(xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str"]]
+
+    packed_data = packed_data_from_xyz_strs(xyz_strs)
+    packed_data_without_edges = packed_data_from_xyz_strs(xyz_strs, store_edges=False)
+    assert "e" not in packed_data_without_edges, "Expected edges not to be stored"
+    assert "edge_offsets" not in packed_data_without_edges, "Expected edge offsets not to be stored"
+
+    for idx in range(len(xyz_strs)):
+        data_dict = data_dict_from_packed_data(packed_data, idx)
+        data_dict_without_edges = data_dict_from_packed_data(packed_data_without_edges, idx)
+        if data_dict["e"] is None:
+            assert data_dict_without_edges["e"] is None, "Output is incorrect"
+        else:
+            assert torch.equal(data_dict["e"], data_dict_without_edges["e"]), "Output is incorrect"
+
+    # Edges built from the shared template must not alias it
+    for widen in (True, False):
+        data_dict_from_packed_data(packed_data_without_edges, 0, widen=widen)["e"] += 100
+    assert torch.equal(data_dict_from_packed_data(packed_data_without_edges, 2)["e"], data_dict_from_packed_data(packed_data, 2)["e"]), "Expected an independent copy of the template"
+
+    concatenated_packed_data = concat_packed_data([packed_data_without_edges, packed_data_without_edges])
+    assert "e" not in concatenated_packed_data, "Expected edges not to be stored"
+    assert torch.equal(concatenated_packed_data["segments"], torch.tensor([18, 1, 18, 18, 1, 18])), "Output is incorrect"
+
+
+def test_collate_data_dicts_missing_edges(data_dict_fixture):
+    data_dict = data_dict_fixture["data_dict"]
+    data_dict_without_edges = dict(data_dict, e=None)
+    collated_data_dict = collate_data_dicts([data_dict, data_dict_without_edges])
+    assert torch.equal(collated_data_dict["e"], torch.tensor([
+        [0, 0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5],
+        [1, 2, 0, 2, 0, 1, 4, 5, 5, 3, 3, 4],
+    ])), "Output is incorrect"
+
+
+def test_collate_data_dicts_offsets(xyz_fixture):
+    data_dicts = [data_dict_from_xyz_str(xyz_fixture["xyz_str"]), data_dict_from_xyz_str("3\ngdb 1" + " 0.0" * 15 + "\nO 0.0 0.0 0.0\nH 1.0 0.0 0.0\nH 0.0 1.0 0.0\n"), data_dict_from_xyz_str(xyz_fixture["xyz_str"])]
+    collated_data_dict = collate_data_dicts(data_dicts)
+
+    assert torch.equal(collated_data_dict["segments"], torch.tensor([18, 3, 18])), "Output is incorrect"
+    assert torch.equal(collated_data_dict["e"][:, :306], data_dicts[0]["e"]), "Output is incorrect"
+    assert torch.equal(collated_data_dict["e"][:, 306:312], data_dicts[1]["e"] + 18), "Output is incorrect"
+    assert torch.equal(collated_data_dict["e"][:, 312:], data_dicts[2]["e"] + 21), "Output is incorrect"
+
+
+def test_collate_data_dicts_dense_value(xyz_fixture):
+    data_dicts = [data_dict_from_xyz_str(xyz_fixture["xyz_str"]), data_dict_from_xyz_str("3\ngdb 1" + " 0.0" * 15 + "\nO 0.0 0.0 0.0\nH 1.0 0.0 0.0\nH 0.0 1.0 0.0\n")]
+    dense_data_dict = collate_data_dicts_dense(data_dicts)
+
+    assert dense_data_dict["h"].shape == (2, 18, 5), "Output shape is incorrect"
+    assert dense_data_dict["x"].shape == (2, 18, 3), "Output shape is incorrect"
+    assert torch.equal(dense_data_dict["h"][0], data_dicts[0]["h"]), "Output is incorrect"
+    assert torch.equal(dense_data_dict["x"][0], data_dicts[0]["x"]), "Output is incorrect"
+    assert torch.equal(dense_data_dict["h"][1, :3], data_dicts[1]["h"]), "Output is incorrect"
+    assert torch.equal(dense_data_dict["x"][1, :3], data_dicts[1]["x"]), "Output is incorrect"
+    assert torch.all(dense_data_dict["h"][1, 3:] == 0.0), "Expected zero padding"
+    assert torch.all(dense_data_dict["x"][1, 3:] == 0.0), "Expected zero padding"
+    assert dense_data_dict["node_mask"].sum(dim=1).tolist() == [18, 3], "Output is incorrect"
+    assert torch.equal(dense_data_dict["node_mask"][1], torch.arange(18) < 3), "Output is incorrect"
+
+    node_mask = dense_data_dict["node_mask"]
+    expected_edge_mask = node_mask[:, :, None] & node_mask[:, None, :] & ~torch.eye(18, dtype=torch.bool)
+    assert torch.equal(dense_data_dict["edge_mask"], expected_edge_mask), "Output is incorrect"
+
+
+def test_collate_data_dicts_dense_max_num_nodes(xyz_fixture):
+    data_dicts = [data_dict_from_xyz_str(xyz_fixture["xyz_str"])]
+
+    dense_data_dict = collate_data_dicts_dense(data_dicts, max_num_nodes=MAX_NUM_NODES)
+    assert dense_data_dict["h"].shape == (1, 29, 5), "Output shape is incorrect"
+    assert dense_data_dict["edge_mask"].shape == (1, 29, 29), "Output shape is incorrect"
+
+    with pytest.raises(ValueError, match="does not fit"):
+        collate_data_dicts_dense(data_dicts, max_num_nodes=10)
+
+
+def test_packed_data_from_xyz_strs_properties(xyz_fixture):
+    xyz_data_dict = xyz_fixture["xyz_data_dict"]
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"]]
+
+    packed_data = packed_data_from_xyz_strs(xyz_strs)
+    assert packed_data["g"].shape == (2, len(PROPERTY_NAMES)), "Output shape is incorrect"
+    assert torch.equal(packed_data["g"][:1], xyz_data_dict["g"]), "Output is incorrect"
+    assert torch.all(torch.isnan(packed_data["g"][1])), "Expected NaN for a molecule without properties"
+
+    assert torch.equal(data_dict_from_packed_data(packed_data, 0)["g"], xyz_data_dict["g"]), "Output is incorrect"
+
+    # Streamed and cached molecules without properties carry the same NaN row, so they collate together
+    one_atom_data_dict = data_dict_from_xyz_str(xyz_strs[1])
+    assert torch.equal(data_dict_from_packed_data(packed_data, 1)["g"].nan_to_num(), one_atom_data_dict["g"].nan_to_num()), "Output is incorrect"
+    collated_data_dict = collate_data_dicts([one_atom_data_dict, data_dict_from_packed_data(packed_data, 0)])
+    assert collated_data_dict["g"].shape == (2, len(PROPERTY_NAMES)), "Output shape is incorrect"
+
+    packed_data = packed_data_from_xyz_strs(xyz_strs[1:])
+    assert torch.all(torch.isnan(packed_data["g"])), "Expected NaN rows for molecules without properties"
+
+
+def test_property_stats_from_properties_value():
+    g = torch.tensor([
+        [1.0, 10.0],
+        [3.0, 30.0],
+        [torch.nan, torch.nan],
+        [5.0, 50.0],
+    ], dtype=torch.float64)
+
+    property_stats = property_stats_from_properties(g)
+    assert torch.equal(property_stats["mean"], torch.tensor([3.0, 30.0], dtype=torch.float64)), "Output is incorrect"
+    assert torch.equal(property_stats["std"], torch.tensor([2.0, 20.0], dtype=torch.float64)), "Output is incorrect"
+    assert torch.equal(property_stats["min"], torch.tensor([1.0, 10.0], dtype=torch.float64)), "Output is incorrect"
+    assert torch.equal(property_stats["max"], torch.tensor([5.0, 50.0], dtype=torch.float64)), "Output is incorrect"
+
+
+def test_slice_packed_data_inverse(xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_sci_notation"]]
+
+    for store_edges in (True, False):
+        packed_data = packed_data_from_xyz_strs(xyz_strs, store_edges=store_edges)
+        sliced_packed_datas = [slice_packed_data(packed_data, 0, 1), slice_packed_data(packed_data, 1, 3), slice_packed_data(packed_data, 3, 4)]
+        assert torch.equal(sliced_packed_datas[1]["node_offsets"], torch.tensor([0, 1, 19])), "Output is incorrect"
+
+        concatenated_packed_data = concat_packed_data(sliced_packed_datas)
+        for key in packed_data:
+            if key != "version":
+                assert torch.equal(concatenated_packed_data[key].nan_to_num(), packed_data[key].nan_to_num()), f"Output {key} is incorrect"
+
+
+def test_radius_edge_index_from_positions_value():
+    x = torch.tensor([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [3.0, 0.0, 0.0], [3.5, 0.0, 0.0]])
+    e = edge_index_from_num_nodes(4)
+
+    radius_e = radius_edge_index_from_positions(x, e, 1.5)
+    assert sorted(map(tuple, radius_e.T.tolist())) == [(0, 1), (1, 0), (2, 3), (3, 2)], "Output is incorrect"
+
+    radius_e = radius_edge_index_from_positions(x, e, 2.5, max_num_neighbors=1)
+    assert sorted(map(tuple, radius_e.T.tolist())) == [(0, 1), (1, 0), (2, 3), (3, 2)], "Output is incorrect"
+
+    radius_e = radius_edge_index_from_positions(x, e, 10.0)
+    assert torch.equal(radius_e, e), "Expected the full graph within a large cutoff"
+
+    radius_e = radius_edge_index_from_positions(x, e, 0.1)
+    assert radius_e.shape == (2, 0), "Expected no edges"
+
+
+def test_packed_data_from_xyz_strs_cutoff(xyz_fixture):
+    far_xyz_str = "2\nfoo\nH 0.0 0.0 0.0\nH 10.0 0.0 0.0\n"
+    xyz_strs = [xyz_fixture["xyz_str"], far_xyz_str, xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str"]]
+
+    packed_data = packed_data_from_xyz_strs(xyz_strs, cutoff=2.0, max_num_neighbors=4)
+    for idx, xyz_str in enumerate(xyz_strs):
+        data_dict = data_dict_from_packed_data(packed_data, idx)
+        expected_data_dict = data_dict_from_xyz_str(xyz_str, cutoff=2.0, max_num_neighbors=4)
+        if expected_data_dict["e"] is None:
+            assert data_dict["e"] is None, "Output is incorrect"
+        else:
+            assert torch.equal(data_dict["e"], expected_data_dict["e"]), "Output is incorrect"
+
+    e = data_dict_from_packed_data(packed_data, 0)["e"]
+    x = data_dict_from_packed_data(packed_data, 0)["x"]
+    assert 0 < e.shape[1] < 18 * 17, "Expected fewer edges than the full graph"
+    assert torch.all(torch.linalg.vector_norm(x[e[0]] - x[e[1]], dim=1) <= 2.0), "Expected every edge within the cutoff"
+    assert torch.all(torch.bincount(e[0]) <= 4), "Expected at most 4 neighbors per node"
+    assert data_dict_from_packed_data(packed_data, 1)["e"].shape == (2, 0), "Expected no edges for distant atoms"
+
+
+def test_collate_data_dicts_cutoff(xyz_fixture):
+    far_xyz_str = "2\ngdb 1" + " 0.0" * 15 + "\nH 0.0 0.0 0.0\nH 10.0 0.0 0.0\n"
+    xyz_strs = [xyz_fixture["xyz_str"], far_xyz_str, xyz_fixture["xyz_str"]]
+
+    collated_data_dict = collate_data_dicts([data_dict_from_xyz_str(xyz_str) for xyz_str in xyz_strs], cutoff=2.0, max_num_neighbors=4)
+    expected_data_dict = collate_data_dicts([data_dict_from_xyz_str(xyz_str, cutoff=2.0, max_num_neighbors=4) for xyz_str in xyz_strs])
+    assert torch.equal(collated_data_dict["e"], expected_data_dict["e"]), "Expected per-batch and precomputed radius graphs to match"
+
+
+def test_xyz_strs_from_data_dict_value(xyz_fixture):
+    three_atom_xyz_str = "3\nfoo\nC 0.0 0.0 0.0\nO 1.2 0.0 0.0\nH -0.5 0.9 0.0\n"
+    xyz_strs = [three_atom_xyz_str, xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str_with_sci_notation"]]
+    data_dicts = [data_dict_from_xyz_str(xyz_str) for xyz_str in xyz_strs]
+
+    collated_xyz_strs = xyz_strs_from_data_dict(collate_data_dicts(data_dicts), comments=["a", "b", "c"])
+    assert len(collated_xyz_strs) == 3, f"Expected 3 molecules, got {len(collated_xyz_strs)}"
+    for collated_xyz_str, data_dict, comment in zip(collated_xyz_strs, data_dicts, ["a", "b", "c"]):
+        expected_lines = xyz_str_from_data_dict(data_dict).splitlines()
+        expected_lines[1] = comment
+        assert collated_xyz_str.splitlines() == expected_lines, "Output is incorrect"
+
+    # Soft features from a generative model decode to their most likely element
+    soft_data_dict = {"h": torch.tensor([[0.1, 0.7, 0.1, 0.1, 0.0]]), "x": torch.zeros((1, 3)), "segments": torch.tensor([1])}
+    assert xyz_strs_from_data_dict(soft_data_dict)[0].splitlines()[2].startswith("C "), "Output is incorrect"
+
+
+def test_write_xyz(tmp_path, xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"]]
+    packed_data = packed_data_from_xyz_strs(xyz_strs)
+    expected_xyz_strs = xyz_strs_from_data_dict(packed_data)
+
+    assert write_xyz([slice_packed_data(packed_data, 0, 1), slice_packed_data(packed_data, 1, 2)], tmp_path / "molecules.xyz") == 2, "Output is incorrect"
+    assert (tmp_path / "molecules.xyz").read_text() == "".join(expected_xyz_strs), "Output is incorrect"
+
+    assert write_xyz(packed_data, tmp_path / "molecules.tar.bz2") == 2, "Output is incorrect"
+    with tarfile.open(tmp_path / "molecules.tar.bz2", "r:bz2") as tar:
+        assert tar.getnames() == ["molecule_000000.xyz", "molecule_000001.xyz"], "Output is incorrect"
+        assert [tar.extractfile(name).read().decode("utf-8") for name in tar.getnames()] == expected_xyz_strs, "Output is incorrect"
+
+    data_dict = data_dict_from_xyz_str(expected_xyz_strs[0])
+    assert torch.allclose(data_dict["x"], data_dict_from_xyz_str(xyz_strs[0])["x"], atol=1e-3), "Output is incorrect"
+
+
+def test_center_positions_value(xyz_fixture):
+    three_atom_xyz_str = "3\nfoo\nC 0.0 0.0 0.0\nO 1.2 0.0 0.0\nH -0.5 0.9 0.0\n"
+    data_dicts = [data_dict_from_xyz_str(xyz_str) for xyz_str in [three_atom_xyz_str, xyz_fixture["xyz_str_with_one_atom"], three_atom_xyz_str]]
+    collated_data_dict = collate_data_dicts(data_dicts)
+
+    x = center_positions(collated_data_dict["x"], collated_data_dict["segments"])
+    expected_x = torch.cat([data_dict["x"] - torch.mean(data_dict["x"], dim=0, keepdim=True) for data_dict in data_dicts])
+    assert x.dtype == torch.float32, "Expected the input dtype"
+    assert torch.allclose(x, expected_x, atol=1e-6), "Output is incorrect"
+
+
+def test_random_rotation_matrices_value():
+    rotations = random_rotation_matrices(100, generator=torch.Generator().manual_seed(0))
+
+    assert rotations.shape == (100, 3, 3), f"Expected shape (100, 3, 3), got {rotations.shape}"
+    assert torch.allclose(rotations @ rotations.transpose(1, 2), torch.eye(3, dtype=torch.float64).expand(100, 3, 3), atol=1e-12), "Expected orthogonal matrices"
+    assert torch.allclose(torch.linalg.det(rotations), torch.ones(100, dtype=torch.float64)), "Expected proper rotations"
+    assert torch.equal(rotations, random_rotation_matrices(100, generator=torch.Generator().manual_seed(0))), "Expected the same rotations for the same seed"
+
+
+def test_rotate_data_dict_value(xyz_fixture):
+    data_dicts = [data_dict_from_xyz_str(xyz_fixture["xyz_str"]) for _ in range(3)]
+    collated_data_dict = collate_data_dicts(data_dicts)
+    collated_data_dict["x"] = center_positions(collated_data_dict["x"], collated_data_dict["segments"])
+
+    rotated_data_dict = rotate_data_dict(collated_data_dict, generator=torch.Generator().manual_seed(0))
+    x = collated_data_dict["x"].view(3, 18, 3)
+    rotated_x = rotated_data_dict["x"].view(3, 18, 3)
+
+    assert torch.allclose(torch.cdist(rotated_x, rotated_x), torch.cdist(x, x), atol=1e-4), "Expected distances to be preserved"
+    assert not torch.allclose(rotated_x[0], rotated_x[1]), "Expected a different rotation for every molecule"
+    assert torch.allclose(rotated_x.mean(dim=1), torch.zeros(3, 3), atol=1e-5), "Expected centered molecules to stay centered"
+    assert torch.equal(rotated_data_dict["e"], collated_data_dict["e"]), "Expected edges to be unchanged"
+    assert torch.equal(rotate_data_dict(collated_data_dict, generator=torch.Generator().manual_seed(0))["x"], rotated_data_dict["x"]), "Expected the same rotation for the same seed"
+
+
+def test_collate_data_dicts_compact(xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str"]]
+    packed_data = packed_data_from_xyz_strs(xyz_strs)
+
+    compact_data_dicts = [data_dict_from_packed_data(packed_data, idx, widen=False) for idx in range(len(xyz_strs))]
+    data_dicts = [data_dict_from_packed_data(packed_data, idx) for idx in range(len(xyz_strs))]
+    assert compact_data_dicts[0]["h"].dtype == torch.uint8, "Expected compact element indices"
+    assert torch.equal(widen_data_dict(compact_data_dicts[0])["h"], data_dicts[0]["h"]), "Output is incorrect"
+
+    collated_data_dict = collate_data_dicts(compact_data_dicts)
+    expected_data_dict = collate_data_dicts(data_dicts)
+    for key in ("h", "x", "e", "segments"):
+        assert collated_data_dict[key].dtype == expected_data_dict[key].dtype, f"Output {key} dtype is incorrect"
+        assert torch.equal(collated_data_dict[key], expected_data_dict[key]), f"Output {key} is incorrect"
+
+    half_data_dict = collate_data_dicts(compact_data_dicts, dtype=torch.bfloat16)
+    assert half_data_dict["h"].dtype == torch.bfloat16 and half_data_dict["x"].dtype == torch.bfloat16, "Expected the requested dtype"
+    assert torch.equal(half_data_dict["h"], expected_data_dict["h"].to(torch.bfloat16)), "Output is incorrect"
+    assert xyz_strs_from_data_dict(packed_data) == xyz_strs_from_data_dict(expected_data_dict), "Output is incorrect"
+
+
+def test_keys_from_xyz_str(xyz_fixture):
+    gdb_id, smiles, inchi = keys_from_xyz_str(xyz_fixture["xyz_str"])
+    assert gdb_id == 133859, f"Expected gdb id 133859, got {gdb_id}"
+    assert smiles == "CN1C2C3C4=CCC13C24", f"Output is incorrect, got {smiles}"
+    assert inchi == "InChI=1S/C8H9N/c1-9-7-5-4-2-3-8(5,9)6(4)7/h2,5-7H,3H2,1H3", f"Output is incorrect, got {inchi}"
+    assert keys_from_xyz_str(xyz_fixture["xyz_str_with_one_atom"]) == (-1, "", ""), "Expected missing keys"
+
+
+def test_hash_table_lookup():
+    keys = [f"C{i % 700}" for i in range(1000)] + [""]
+    key_hashes = key_hashes_from_strs(keys)
+    table = hash_table_from_key_hashes(key_hashes)
+    assert table.shape[0] >= 2 * len(keys), "Expected the table to respect the load factor"
+    assert sorted(table[table >= 0].tolist()) == [i for i, key in enumerate(keys) if key], "Expected every non-empty key exactly once"
+
+    query_hashes = key_hashes_from_strs(["C0", "C699", "C700", "", "N1"])
+    assert indices_from_hash_table(table, key_hashes, query_hashes).tolist() == [0, 699, -1, -1, -1], "Expected the lowest matching index"
+
+    # Collide every key on the same home slot
+    colliding_hashes = torch.tensor([5, 5 + 64, 5, 7], dtype=torch.int64)
+    colliding_table = hash_table_from_key_hashes(colliding_hashes)
+    assert indices_from_hash_table(colliding_table, colliding_hashes, torch.tensor([5 + 64, 5, 7, 6])).tolist() == [1, 0, 3, -1], "Output is incorrect"
+
+
+def test_gdb_table_from_gdb_ids():
+    table = gdb_table_from_gdb_ids(torch.tensor([3, -1, 1, 3], dtype=torch.int32))
+    assert table.tolist() == [-1, 2, -1, 0], "Output is incorrect"
+    assert gdb_table_from_gdb_ids(torch.tensor([-1], dtype=torch.int32)).shape == (0,), "Expected an empty table"
+
+
+def test_element_counts_from_packed_data(xyz_fixture):
+    packed_data = packed_data_from_xyz_strs([xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"]])
+    element_counts = element_counts_from_packed_data(packed_data)
+    assert element_counts.dtype == torch.uint8, "Expected compact counts"
+    assert element_counts.tolist() == [[9, 8, 1, 0, 0], [1, 0, 0, 0, 0]], "Output is incorrect"
+    assert element_masks_from_element_counts(element_counts).tolist() == [0b00111, 0b00001], "Output is incorrect"
+
+
+def test_element_counts_from_formula():
+    assert element_counts_from_formula("C7H10O2").tolist() == [10, 7, 0, 2, 0], "Output is incorrect"
+    assert element_counts_from_formula("CH4").tolist() == [4, 1, 0, 0, 0], "Output is incorrect"
+    with pytest.raises(ValueError, match="Unknown element"):
+        element_counts_from_formula("CCl4")
+    with pytest.raises(ValueError, match="Invalid formula"):
+        element_counts_from_formula("c7h10")
+
+
+def test_composition_mask():
+    element_counts = torch.tensor([[10, 7, 0, 2, 0], [4, 1, 0, 0, 0], [3, 5, 1, 1, 1], [0, 9, 0, 0, 0]], dtype=torch.uint8)
+    element_masks = element_masks_from_element_counts(element_counts)
+
+    assert composition_mask(element_counts, element_masks, formula="C7H10O2").tolist() == [True, False, False, False], "Output is incorrect"
+    assert composition_mask(element_counts, element_masks, exclude_elements=["F"]).tolist() == [True, True, False, True], "Output is incorrect"
+    assert composition_mask(element_counts, element_masks, include_elements=["C", "H"]).tolist() == [True, True, True, False], "Output is incorrect"
+    assert composition_mask(element_counts, element_masks, max_num_heavy_atoms=8).tolist() == [False, True, True, False], "Output is incorrect"
+    assert composition_mask(element_counts, element_masks, predicate=lambda columns: columns["num_nodes"] > 5, min_num_heavy_atoms=9).tolist() == [True, False, False, True], "Output is incorrect"
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="Requires CUDA")
+def test_rotate_data_dict_cuda(xyz_fixture):
+    collated_data_dict = collate_data_dicts([data_dict_from_xyz_str(xyz_fixture["xyz_str"]) for _ in range(2)])
+    cuda_data_dict = {key: value.cuda() if isinstance(value, torch.Tensor) else value for key, value in collated_data_dict.items()}
+
+    rotated_data_dict = rotate_data_dict(cuda_data_dict, generator=torch.Generator().manual_seed(0))
+    assert rotated_data_dict["x"].device == cuda_data_dict["x"].device, "Expected the batch to stay on its device"
+    assert torch.allclose(rotated_data_dict["x"].cpu(), rotate_data_dict(collated_data_dict, generator=torch.Generator().manual_seed(0))["x"], atol=1e-5), "Expected the same rotation on every device"
+
+
+def assert_collated_equal(collated_data_dict, expected_data_dict):
+    for key in ("h", "x", "e", "segments"):
+        assert collated_data_dict[key].dtype == expected_data_dict[key].dtype, f"Output {key} dtype is incorrect"
+        assert torch.equal(collated_data_dict[key], expected_data_dict[key]), f"Output {key} is incorrect"
+    assert torch.equal(collated_data_dict["g"].nan_to_num(), expected_data_dict["g"].nan_to_num()), "Output g is incorrect"
+
+
+def test_collate_packed_data_value(xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str"]]
+    indices = [2, 1, 0, -1]
+    for store_edges in (True, False):
+        packed_data = packed_data_from_xyz_strs(xyz_strs, store_edges=store_edges)
+        expected_data_dict = collate_data_dicts([data_dict_from_packed_data(packed_data, idx) for idx in indices])
+        assert_collated_equal(collate_packed_data(packed_data, indices), expected_data_dict)
+
+        expected_data_dict = collate_data_dicts([data_dict_from_packed_data(packed_data, idx, widen=False) for idx in indices], cutoff=2.0, max_num_neighbors=4, dtype=torch.float64)
+        assert_collated_equal(collate_packed_data(packed_data, indices, cutoff=2.0, max_num_neighbors=4, dtype=torch.float64), expected_data_dict)
+
+    assert collate_packed_data(packed_data, [])["e"].shape == (2, 0), "Output shape is incorrect"
+    with pytest.raises(IndexError):
+        collate_packed_data(packed_data, [3])
+
+
+def test_gather_packed_data_value(xyz_fixture):
+    xyz_strs = [xyz_fixture["xyz_str"], xyz_fixture["xyz_str_with_one_atom"], xyz_fixture["xyz_str"]]
+    packed_data = packed_data_from_xyz_strs(xyz_strs)
+    gathered_packed_data = gather_packed_data(packed_data, torch.tensor([1, 0]))
+    assert gathered_packed_data["node_offsets"].tolist() == [0, 1, 19], "Output is incorrect"
+    assert gathered_packed_data["edge_offsets"].tolist() == [0, 0, 306], "Output is incorrect"
+    for key in ("h", "x", "e", "segments"):
+        assert gathered_packed_data[key].dtype == packed_data[key].dtype, f"Expected compact {key} to stay compact"
+    assert_collated_equal(collate_packed_data(gathered_packed_data), collate_packed_data(packed_data, [1, 0]))
+